@@ -0,0 +1,71 @@
+# The importer runs inside Blender: bpy and mathutils only exist there, so they are replaced here by stand-ins
+# just good enough for the module to load and for the parts under test to run.
+
+import importlib
+import os
+import sys
+import types
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def blenderModules():
+    bpy = mock.MagicMock()
+    bpy.types.Operator = type("Operator", (), {})
+    io_utils = types.ModuleType("bpy_extras.io_utils")
+    io_utils.ImportHelper = type("ImportHelper", (), {})
+    bpy_extras = types.ModuleType("bpy_extras")
+    bpy_extras.io_utils = io_utils
+    mathutils = types.ModuleType("mathutils")
+    mathutils.Vector = mathutils.Matrix = mathutils.Quaternion = mock.MagicMock()
+    return {"bpy": bpy, "bpy.props": bpy.props, "bpy.types": bpy.types, "bpy_extras": bpy_extras,
+        "bpy_extras.io_utils": io_utils, "mathutils": mathutils}
+
+sys.modules.update(blenderModules()) # Blender's own modules don't exist outside of it, nothing is shadowed
+import ultimaModelImporter
+
+bpy = ultimaModelImporter.bpy
+
+def decodedFrames(archive, frames, *arguments, prefetch = None):
+    for frame in frames:
+        yield frame, ({"width": 1, "height": 1, "isTransparent": False, "is8bit": False}, None)
+
+def test_stopped_texture_loading_keeps_the_frames_left_queued():
+    frames = [(1, 0), (2, 0), (3, 0), (4, 1)]
+    ultimaModelImporter.neededTextures[:] = frames
+    with mock.patch.object(ultimaModelImporter.ultimaFormats, "decodeTextureFrames", decodedFrames), \
+        mock.patch.object(ultimaModelImporter, "makeTexture", return_value = (mock.sentinel.image, False, False)):
+        steps = ultimaModelImporter.makeMaterials(None, useParallelDecoding = False)
+        assert next(steps) == ("Loading textures", 1, 4)
+        assert next(steps) == ("Loading textures", 2, 4)
+        steps.close()
+    assert ultimaModelImporter.neededTextures == frames[2:]
+
+def test_finished_texture_loading_empties_the_queue():
+    ultimaModelImporter.neededTextures[:] = [(1, 0), (2, 0), (1, 0)]
+    with mock.patch.object(ultimaModelImporter.ultimaFormats, "decodeTextureFrames", decodedFrames), \
+        mock.patch.object(ultimaModelImporter, "makeTexture", return_value = (mock.sentinel.image, False, False)):
+        progress = list(ultimaModelImporter.makeMaterials(None, useParallelDecoding = False))
+    assert progress[-1] == ("Loading textures", 2, 2)
+    assert ultimaModelImporter.neededTextures == []
+
+def test_external_images_reuse_the_image_of_a_file_stored_relative_to_the_blend_file():
+    blendDirectory = os.path.abspath("blend")
+    linked = types.SimpleNamespace(source = 'FILE', filepath = "//ultima9_textures/bitmap16/1_0.tga", library = None)
+    absolutePath = lambda path, library = None: os.path.join(blendDirectory, path[2:]) if path.startswith("//") else path
+    with mock.patch.object(bpy.data, "images", mock.MagicMock()) as images, mock.patch.object(bpy.path, "abspath", absolutePath):
+        images.__iter__.return_value = [linked]
+        externalImages = ultimaModelImporter.ultimaBlender.ExternalImages()
+        assert externalImages.load("bitmap16_1_0", os.path.join(blendDirectory, "ultima9_textures", "bitmap16", "1_0.tga")) is linked
+        images.load.assert_not_called()
+        other = externalImages.load("bitmap16_2_0", os.path.join(blendDirectory, "ultima9_textures", "bitmap16", "2_0.tga"))
+        assert other is images.load.return_value
+        assert externalImages.load("bitmap16_2_0", os.path.join(blendDirectory, "ultima9_textures", "bitmap16", "2_0.tga")) is other
+        images.load.assert_called_once()
+
+def test_reloading_the_importer_reloads_the_shared_modules():
+    ultimaModelImporter.ultimaFormats.defaultPrefetchBytes = 1
+    ultimaModelImporter.ultimaBlender.ExternalImages = None
+    importlib.reload(ultimaModelImporter)
+    assert ultimaModelImporter.ultimaFormats.defaultPrefetchBytes == 256 * 1024 * 1024
+    assert ultimaModelImporter.ultimaBlender.ExternalImages is not None
@@ -0,0 +1,38 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ultimaShared import ultimaFormats
+
+class Calls:
+    # a frame function recording which frames it ran for
+    def __init__(self):
+        self.frames = []
+        self.lock = threading.Lock()
+
+    def __call__(self, archive, textureIndex, frameIndex, suffix):
+        with self.lock:
+            self.frames.append((textureIndex, frameIndex))
+        return "{0}_{1}{2}".format(textureIndex, frameIndex, suffix)
+
+def test_prefetched_frames_are_taken_instead_of_done_again():
+    frames = [(1, 0), (2, 0), (3, 1), (4, 0)]
+    for workers in (1, 4):
+        calls = Calls()
+        prefetch = ultimaFormats.TexturePrefetch(calls, None, frames[:2] + [(9, 9)], ("!",), workers = 2)
+        try:
+            results = list(ultimaFormats.mapTextureFrames(calls, None, frames, workers, "!", prefetch = prefetch))
+        finally:
+            prefetch.close()
+        assert results == [(frame, "{0}_{1}!".format(*frame)) for frame in frames]
+        assert sorted(calls.frames) == sorted(frames + [(9, 9)]) # each frame once, the unused one prefetched for nothing
+
+def test_prefetch_stops_at_its_byte_budget():
+    calls = Calls()
+    prefetch = ultimaFormats.TexturePrefetch(calls, None, [(1, 0), (2, 0), (3, 0)], ("",),
+        frameBytes = lambda archive, textureIndex, frameIndex: 100, maxBytes = 250)
+    prefetch.close()
+    assert len(calls.frames) <= 2
+    assert prefetch.take((3, 0)) is None
@@ -0,0 +1,319 @@
+# Throughput benchmarks for the format readers of ultimaFormats, runnable outside Blender:
+#     python tools/ultimaBenchmark.py [--scale 4] [--repeat 5] [--directory somewhere] [--json report.json]
+# No game files are needed: synthetic but format-valid sappear.flx, bitmap16.flx, types.dat, fixed, nonfixed
+# and terrain files are written first (to a temporary directory unless one is given), then each reader
+# is timed over them and reported in MB/s and records/s. The best of the repeats is kept.
+
+import argparse
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the shared modules are one folder up
+from ultimaShared import ultimaFormats
+
+###synthetic files
+
+def syntheticSizes(scale = 1):
+    sizes = dict()
+    sizes["textures"] = 64 * scale # bitmap16.flx records
+    sizes["frames"] = 4 # frames per texture
+    sizes["textureSize"] = 64 # width and height of the frames
+    sizes["models"] = 64 * scale # sappear.flx records
+    sizes["bones"] = 3 # bones per model
+    sizes["lods"] = 2 # submeshes per bone
+    sizes["faces"] = 96 # faces per submesh
+    sizes["types"] = 4096 * scale # types.dat entries
+    sizes["pages"] = 16 * scale # pages of the fixed and nonfixed files, laid out as a square-ish region
+    sizes["terrainChunks"] = 8 * scale # terrain width and height in chunks
+    sizes["terrainTemplates"] = 256 # distinct chunk templates
+    return sizes
+
+def packArchive(records):
+    # FLX archive: 0x80 bytes header, (offset, size) table, then the records.
+    count = len(records)
+    offset = ultimaFormats.archiveHeaderFormat.size + 8 * count
+    table = []
+    for record in records:
+        table.extend((offset, len(record)))
+        offset += len(record)
+    header = ultimaFormats.archiveHeaderFormat.pack(b"\x20" * 76, 0, count, 2, offset, offset, 0, 0, 1, 0, bytes(16))
+    return b"".join([header, struct.pack("<{0}I".format(2 * count), *table)] + list(records))
+
+def packTexture(random, frameCount, size, kind):
+    # kind is one of "565", "5551" or "8bit"; frames have no mip levels (format 0).
+    frames = []
+    for i in range(frameCount):
+        headerSize = ultimaFormats.frameHeaderFormat.size + 4 * size
+        rowLength = size if kind == "8bit" else 2 * size
+        rowOffsets = [headerSize + row * rowLength for row in range(size)] # not read by the importer, but plausible
+        unknown1 = 0x100 if kind == "5551" else 0
+        frameHeader = ultimaFormats.frameHeaderFormat.pack(unknown1, 0x6000, size, size, 0, 0)
+        dtype = numpy.uint8 if kind == "8bit" else numpy.dtype("<u2")
+        pixels = random.integers(0, numpy.iinfo(dtype).max, size * size, endpoint = True).astype(dtype)
+        frames.append(frameHeader + struct.pack("<{0}I".format(size), *rowOffsets) + pixels.tobytes())
+    offset = ultimaFormats.textureSetHeaderFormat.size + 8 * frameCount
+    table = []
+    for frame in frames:
+        table.extend((offset, len(frame)))
+        offset += len(frame)
+    header = ultimaFormats.textureSetHeaderFormat.pack(size, 0, size, 0, frameCount, 0)
+    return b"".join([header, struct.pack("<{0}I".format(2 * frameCount), *table)] + frames)
+
+def packSubmesh(random, faceCount):
+    # Header, then faces, vertices and materials; their offsets are relative to the start of the submesh plus 4.
+    vertexCount = faceCount + 2
+    materialCount = 4
+    faces = numpy.zeros(faceCount, dtype = ultimaFormats.faceDtype)
+    faces["Points"]["index"] = random.integers(0, vertexCount, (faceCount, 3))
+    faces["Points"]["normal"] = random.standard_normal((faceCount, 3, 3))
+    faces["Points"]["texCoord"] = random.random((faceCount, 3, 2))
+    faces["Normal"] = random.standard_normal((faceCount, 3))
+    faces["color"] = random.integers(0, 255, (faceCount, 4), endpoint = True)
+    vertices = numpy.zeros(vertexCount, dtype = ultimaFormats.vertexDtype)
+    vertices["position"] = random.uniform(-100, 100, (vertexCount, 3))
+    materials = numpy.zeros(materialCount, dtype = ultimaFormats.materialDtype)
+    materials["Texture ID"] = random.integers(0, 64, materialCount)
+    firstFaces = numpy.linspace(0, faceCount, materialCount + 1).astype(numpy.uint16)
+    materials["First Face ID"] = firstFaces[:-1]
+    materials["Face Count"] = numpy.diff(firstFaces)
+
+    faceOffset = ultimaFormats.submeshHeaderFormat.size - 4
+    vertexOffset = faceOffset + faces.nbytes
+    materialOffset = vertexOffset + vertices.nbytes
+    meshSize = materialOffset + materials.nbytes
+    header = ultimaFormats.submeshHeaderFormat.pack(meshSize, 4, 0, 0, 0, 0, 100, -100, -100, -100, 100, 100, 100, 0, 0,
+        faceCount, 0, vertexCount, 0, faceCount, materialCount, faceOffset, 0, vertexOffset, 0, materialOffset, 0, 0, 0, 0, 0)
+    return header + faces.tobytes() + vertices.tobytes() + materials.tobytes()
+
+def packModel(random, boneCount, lodCount, faceCount):
+    # Model header, offset table (bone header offset then LOD offsets, per bone), bone headers, submeshes.
+    header = ultimaFormats.modelHeaderFormat.pack(boneCount, lodCount, 0, 0, 0, 10, 5, 0, 0, 5, 10, 0,
+        -5, -5, -5, 5, 5, 5, 100, 200, 400, 800, 0, 0, 0, 1, bytes(36), 1)
+    offset = len(header) + 4 * boneCount * (1 + lodCount)
+    table = []
+    blocks = []
+    for bone in range(boneCount):
+        table.append(offset)
+        boneHeader = ultimaFormats.boneHeaderFormat.pack(bone, max(bone - 1, 0), 1, 1, 1, 0, 0, bone * 10, 1, 0, 0, 0)
+        blocks.append(boneHeader)
+        offset += len(boneHeader)
+        for lod in range(lodCount):
+            table.append(offset)
+            submesh = packSubmesh(random, max(faceCount >> lod, 1))
+            blocks.append(submesh)
+            offset += len(submesh)
+    return b"".join([header, struct.pack("<{0}I".format(len(table)), *table)] + blocks)
+
+def packTypes(random, count):
+    # types.dat: 8 bytes before the first entry, then 16 bytes per type.
+    entries = numpy.zeros(count, dtype = [("unknown1", "<u4"), ("UsecodeID", "<u2"), ("DefaultModelID", "<u2"),
+        ("Type Flags", "<u2"), ("Weight", "u1"), ("Volume", "u1"), ("BookNumber", "u1"), ("Hitpoints", "u1"), ("unknown2", "<u2")])
+    entries["DefaultModelID"] = random.integers(0, 3765, count)
+    return bytes(8) + entries.tobytes()
+
+def regionShape(pageCount):
+    width = max(int(numpy.sqrt(pageCount)), 1)
+    return width, max(pageCount // width, 1)
+
+def packFixed(random, pageCount):
+    width, height = regionShape(pageCount)
+    pageCount = width * height
+    pages = numpy.zeros(pageCount, dtype = ultimaFormats.fixedPageDtype)
+    pages["baseX"] = numpy.arange(pageCount) % width * 4096
+    pages["baseY"] = numpy.arange(pageCount) // width * 4096
+    objects = pages["objects"]
+    objects["type"] = random.integers(0, 2000, objects.shape) # about one in 2000 slots stays empty
+    objects["position"] = random.integers(0, 4096, objects.shape + (3,))
+    objects["angle"] = random.integers(-32767, 32767, objects.shape + (4,), endpoint = True)
+    indices = numpy.arange(pageCount, dtype = "<u4") << 12 | 1
+    header = ultimaFormats.fixedHeaderFormat.pack(0, 0, pages.nbytes, 0, width, height, 0, 0)
+    return header + indices.tobytes() + pages.tobytes()
+
+def packNonfixed(random, pageCount):
+    width, height = regionShape(pageCount)
+    pageCount = width * height
+    pages = numpy.zeros(pageCount, dtype = ultimaFormats.nonfixedPageDtype)
+    pages["baseX"] = numpy.arange(pageCount) % width * 4096
+    pages["baseY"] = numpy.arange(pageCount) // width * 4096
+    pages["entityCount"] = random.integers(1, ultimaFormats.nonfixedPageObjectCount, pageCount, endpoint = True)
+    objects = pages["objects"]
+    objects["type"] = random.integers(1, 2000, objects.shape)
+    objects["position"] = random.integers(0, 4096, objects.shape + (3,))
+    objects["rotation"] = random.integers(-32767, 32767, objects.shape + (4,), endpoint = True)
+    headerSize = ultimaFormats.nonfixedHeaderFormat.size + 4 * pageCount + 4
+    pageOffsets = numpy.arange(pageCount, dtype = "<u4") * ultimaFormats.nonfixedPageDtype.itemsize
+    header = ultimaFormats.nonfixedHeaderFormat.pack(0, 0, 0, 0, 0, width, height, 0)
+    return header + pageOffsets.tobytes() + struct.pack("<I", 0) + pages.tobytes()
+
+def packTerrain(random, chunks, templateCount):
+    size = chunks * ultimaFormats.terrainChunkSize
+    header = ultimaFormats.terrainHeaderFormat.pack(size, size, b"synthetic", 0, 0, 0, templateCount)
+    indices = random.integers(0, templateCount, chunks * chunks).astype("<u2")
+    shape = (templateCount, ultimaFormats.terrainChunkSize, ultimaFormats.terrainChunkSize)
+    words = random.integers(0, 4096, shape).astype("<u4") # height
+    words |= (random.random(shape) < 0.02).astype("<u4") << 12 # a few holes
+    words |= random.integers(0, 8, shape).astype("<u4") << 13 # swap, mirror and diagonal
+    words |= random.integers(0, 8, shape).astype("<u4") << 16 # frame
+    words |= random.integers(0, 64, shape).astype("<u4") << 22 # texture
+    return header + indices.tobytes() + words.tobytes()
+
+def writeSyntheticFiles(directory, sizes, seed = 9):
+    # Writes the synthetic files and returns their paths by kind.
+    random = numpy.random.default_rng(seed)
+    kinds = ("565", "5551", "8bit")
+    contents = dict()
+    contents["bitmap16.flx"] = packArchive([packTexture(random, sizes["frames"], sizes["textureSize"], kinds[i % 3])
+        for i in range(sizes["textures"])])
+    contents["sappear.flx"] = packArchive([packModel(random, sizes["bones"], sizes["lods"], sizes["faces"])
+        for i in range(sizes["models"])])
+    contents["types.dat"] = packTypes(random, sizes["types"])
+    contents["fixed.9"] = packFixed(random, sizes["pages"])
+    contents["nonfixed.9"] = packNonfixed(random, sizes["pages"])
+    contents["terrain.9"] = packTerrain(random, sizes["terrainChunks"], sizes["terrainTemplates"])
+    paths = dict()
+    os.makedirs(directory, exist_ok = True)
+    for name, data in contents.items():
+        paths[name] = os.path.join(directory, name)
+        with open(paths[name], "wb") as file_object:
+            file_object.write(data)
+    return paths
+
+###benchmarks
+
+def readFile(path):
+    with open(path, "rb") as file_object:
+        return file_object.read()
+
+def benchArchive(paths):
+    archive = ultimaFormats.FlxArchive(paths["sappear.flx"])
+    archive.close()
+    return ultimaFormats.archiveHeaderFormat.size + 8 * len(archive), len(archive)
+
+def benchTextures(paths):
+    archive = ultimaFormats.FlxArchive(paths["bitmap16.flx"])
+    byteCount = 0
+    frameCount = 0
+    for textureIndex in range(len(archive)):
+        record = archive.record(textureIndex)
+        for frameIndex in range(ultimaFormats.readTextureSetHeader(record)["count"]):
+            frameHeader = ultimaFormats.readTextureFrame(record, frameIndex)
+            ultimaFormats.decodeFramePixels(record, frameHeader)
+            byteCount += frameHeader["width"] * frameHeader["height"] * (1 if frameHeader["is8bit"] else 2)
+            frameCount += 1
+        del record
+    archive.close()
+    return byteCount, frameCount
+
+def benchModelHierarchies(paths):
+    archive = ultimaFormats.FlxArchive(paths["sappear.flx"])
+    byteCount = 0
+    for modelID in range(len(archive)):
+        header, bones = ultimaFormats.readModelHierarchy(archive.record(modelID))
+        # only the headers and offset table are read, not the submeshes
+        byteCount += ultimaFormats.modelHeaderFormat.size + len(bones) * (4 * (1 + header["LOD Count"]) + ultimaFormats.boneHeaderFormat.size)
+    archive.close()
+    return byteCount, len(archive)
+
+def benchSubmeshes(paths):
+    archive = ultimaFormats.FlxArchive(paths["sappear.flx"])
+    byteCount = 0
+    submeshCount = 0
+    for modelID in range(len(archive)):
+        record = archive.record(modelID)
+        header, bones = ultimaFormats.readModelHierarchy(record)
+        for bone in bones:
+            for offset in bone["lods"]:
+                submesh = ultimaFormats.readSubmeshData(record, offset)
+                if submesh is not None:
+                    byteCount += submesh["header"]["Mesh Size"] + 4
+                    submeshCount += 1
+        del record
+    archive.close()
+    return byteCount, submeshCount
+
+def benchTypes(paths):
+    data = readFile(paths["types.dat"])
+    return len(data), len(ultimaFormats.readTypeModels(data))
+
+def benchFixed(paths):
+    data = readFile(paths["fixed.9"])
+    header, table = ultimaFormats.readFixedObjects(data)
+    return len(data), len(table["type"])
+
+def benchNonfixed(paths):
+    data = readFile(paths["nonfixed.9"])
+    header, table, extraData = ultimaFormats.readNonfixedObjects(data)
+    return len(data), len(table["type"])
+
+def benchTerrain(paths):
+    data = readFile(paths["terrain.9"])
+    header, indices, chunkTemplates = ultimaFormats.readTerrain(data)
+    chunkHeight, chunkWidth = indices.shape
+    ultimaFormats.buildTerrainGeometry(indices, chunkTemplates, (0, 0, chunkWidth, chunkHeight), 3.2, 0.1)
+    return len(data), (chunkHeight * ultimaFormats.terrainChunkSize + 1) * (chunkWidth * ultimaFormats.terrainChunkSize + 1)
+
+# name: (function, what a record is)
+benchmarks = {
+    "archive header": (benchArchive, "records"),
+    "texture frames": (benchTextures, "frames"),
+    "model hierarchies": (benchModelHierarchies, "models"),
+    "submeshes": (benchSubmeshes, "submeshes"),
+    "types": (benchTypes, "types"),
+    "fixed objects": (benchFixed, "objects"),
+    "nonfixed objects": (benchNonfixed, "objects"),
+    "terrain": (benchTerrain, "points"),
+}
+
+def runBenchmarks(paths, repeat = 5, names = None):
+    results = dict()
+    for name, (function, unit) in benchmarks.items():
+        if names and name not in names:
+            continue
+        best = None
+        for i in range(repeat):
+            begin = time.perf_counter()
+            byteCount, recordCount = function(paths)
+            seconds = time.perf_counter() - begin
+            best = seconds if best is None else min(best, seconds)
+        result = dict()
+        result["seconds"] = best
+        result["bytes"] = byteCount
+        result["records"] = recordCount
+        result["unit"] = unit
+        result["MB/s"] = byteCount / best / 1e6 if best > 0 else float("inf")
+        result["records/s"] = recordCount / best if best > 0 else float("inf")
+        results[name] = result
+    return results
+
+def printResults(results):
+    print("{0:<20} {1:>10} {2:>12} {3:>10} {4:>14}".format("reader", "seconds", "MB", "MB/s", "records/s"))
+    for name, result in results.items():
+        print("{0:<20} {1:>10.4f} {2:>12.2f} {3:>10.1f} {4:>14,.0f} {5}".format(name, result["seconds"],
+            result["bytes"] / 1e6, result["MB/s"], result["records/s"], result["unit"]))
+
+def main(arguments = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the Ultima 9 format readers on synthetic files.")
+    parser.add_argument("--scale", type = int, default = 1, help = "multiplies the size of the synthetic files")
+    parser.add_argument("--repeat", type = int, default = 5, help = "runs per reader, the best one is reported")
+    parser.add_argument("--directory", help = "where to write the synthetic files (kept), instead of a temporary directory")
+    parser.add_argument("--only", action = "append", choices = list(benchmarks), help = "run only this reader (repeatable)")
+    parser.add_argument("--json", help = "also write the results to this file")
+    options = parser.parse_args(arguments)
+
+    sizes = syntheticSizes(options.scale)
+    with tempfile.TemporaryDirectory() as temporaryDirectory:
+        paths = writeSyntheticFiles(options.directory or temporaryDirectory, sizes)
+        results = runBenchmarks(paths, options.repeat, options.only)
+    printResults(results)
+    if options.json:
+        with open(options.json, "w") as file_object:
+            json.dump({"sizes": sizes, "repeat": options.repeat, "results": results}, file_object, indent = 2)
+
+if __name__ == "__main__":
+    main()
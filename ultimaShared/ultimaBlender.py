@@ -0,0 +1,288 @@
+# Blender-side helpers shared by the model and terrain importers.
+# They take the plain arrays produced by ultimaFormats and turn them into blender data.
+
+import bpy
+
+import collections
+import cProfile
+import os
+import time
+
+import numpy # bundled with Blender
+
+from . import ultimaFormats
+from . import ultimaProfile
+
+def buildMesh(name, vertices, faces, UVs = None, colors = None, normals = None, materialIDs = None):
+    # Creates a triangle mesh in bulk with foreach_set.
+    # vertices: (n, 3) positions, faces: (f, 3) vertex indices
+    # UVs, colors, normals: one row per loop, in face order (f * 3 rows); materialIDs: one per face.
+    # Without normals the mesh gets auto smooth normals from its vertices.
+    vertices = numpy.asarray(vertices, dtype = numpy.float32).reshape(-1, 3)
+    faces = numpy.asarray(faces, dtype = numpy.int32).reshape(-1, 3)
+    faceCount = len(faces)
+    loopCount = faceCount * 3
+
+    with ultimaProfile.phase("build meshes"):
+        mesh = createMesh(name, vertices, faces, faceCount, loopCount, UVs, colors, materialIDs)
+    with ultimaProfile.phase("custom normals"):
+        mesh.use_auto_smooth = True #needed for custom normals
+        if normals is not None:
+            mesh.normals_split_custom_set(numpy.asarray(normals, dtype = numpy.float32).ravel())
+        else:
+            mesh.normals_split_custom_set_from_vertices(numpy.zeros(len(vertices) * 3, dtype = numpy.float32))
+    return mesh
+
+def createMesh(name, vertices, faces, faceCount, loopCount, UVs, colors, materialIDs):
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(vertices))
+    mesh.vertices.foreach_set("co", vertices.ravel())
+    mesh.loops.add(loopCount)
+    mesh.loops.foreach_set("vertex_index", faces.ravel())
+    mesh.polygons.add(faceCount)
+    mesh.polygons.foreach_set("loop_start", numpy.arange(0, loopCount, 3, dtype = numpy.int32))
+    mesh.polygons.foreach_set("loop_total", numpy.full(faceCount, 3, dtype = numpy.int32))
+    if materialIDs is not None:
+        mesh.polygons.foreach_set("material_index", numpy.asarray(materialIDs, dtype = numpy.int32))
+    mesh.update(calc_edges = True)
+
+    if UVs is not None:
+        uvLayer = mesh.uv_layers.new(name = 'DefaultUV')
+        uvLayer.data.foreach_set("uv", numpy.asarray(UVs, dtype = numpy.float32).ravel())
+    if colors is not None:
+        colorLayer = mesh.vertex_colors.new(name = 'DefaultColors')
+        colorLayer.data.foreach_set("color", numpy.asarray(colors, dtype = numpy.float32).ravel())
+    return mesh
+
+###external textures
+
+def textureFileDirectory():
+    # next to the .blend file once it is saved, so that the files can be moved along with it
+    if bpy.data.filepath:
+        return os.path.join(os.path.dirname(bpy.data.filepath), "ultima9_textures")
+    return bpy.utils.user_resource('DATAFILES', path = "ultima9_textures", create = True)
+
+def getTextureFiles(archive):
+    return ultimaFormats.TextureFiles(textureFileDirectory(), archive)
+
+def imagePathKey(path):
+    return os.path.normcase(os.path.normpath(path))
+
+class ExternalImages:
+    # The images of the blend file linked to external files, by absolute path, so that an import reuses the image
+    # of a file rather than loading it again. images.load(check_existing = True) can't be relied on for that: it compares
+    # the path as it is stored, which is relative to the .blend file once it is saved.
+    def __init__(self):
+        self.images = dict()
+        for image in bpy.data.images:
+            if image.source == 'FILE' and image.filepath:
+                self.images[imagePathKey(bpy.path.abspath(image.filepath, library = image.library))] = image
+
+    def load(self, name, path):
+        # The image only refers to the file, blender reads it when the image is first drawn or rendered.
+        # The path is kept relative to the .blend file when it is saved. An image already linked to the file keeps its name.
+        key = imagePathKey(path)
+        image = self.images.get(key)
+        if image is None:
+            with ultimaProfile.phase("create images"):
+                image = bpy.data.images.load(path)
+                image.name = name
+                if bpy.data.filepath:
+                    image.filepath = bpy.path.relpath(path)
+            self.images[key] = image
+        return image
+
+###scene building
+
+class SceneBuilder:
+    # Creates the objects of an import into a collection of its own, which only goes into the scene once the import
+    # is over (finish): every object linked to a collection of the scene updates its view layers, which gets slower
+    # as the scene grows, while linking into a collection outside of it costs the same all along.
+    # Meshes are kept by the name they were asked for, rather than looked up in bpy.data by name every time.
+    def __init__(self, name):
+        self.collection = bpy.data.collections.new(name)
+        self.meshes = dict()
+        self.lodCollections = dict() # level: collection
+
+    def lodCollection(self, level):
+        # child collection of the import for the meshes of one LOD level, only the first one is shown at first
+        collection = self.lodCollections.get(level)
+        if collection is None:
+            collection = bpy.data.collections.new("{0} LOD {1}".format(self.collection.name, level))
+            self.collection.children.link(collection)
+            collection.hide_viewport = level > 0
+            collection.hide_render = level > 0
+            self.lodCollections[level] = collection
+        return collection
+
+    def newObject(self, name, data = None, collection = None):
+        # into the import collection unless another one is given
+        object = bpy.data.objects.new(name, data)
+        (collection if collection is not None else self.collection).objects.link(object)
+        return object
+
+    def findMesh(self, name):
+        # the mesh made under name by this import, or by an earlier one
+        mesh = self.meshes.get(name)
+        if mesh is None:
+            mesh = bpy.data.meshes.get(name)
+            if mesh is not None:
+                self.meshes[name] = mesh
+        return mesh
+
+    def addMesh(self, name, mesh):
+        self.meshes[name] = mesh
+
+    def finish(self):
+        bpy.context.scene.collection.children.link(self.collection)
+
+###import region
+
+class ImportRegionOptions:
+    # Operator options that limit a map import to part of the map, in blender units. Mixed into the import operators.
+    regionMode: bpy.props.EnumProperty(name = "Region", default = 'ALL', items = (
+        ('ALL', "Whole map", "Import the whole map"),
+        ('RECTANGLE', "Rectangle", "Import what lies between the two corners"),
+        ('RADIUS', "Radius", "Import what lies within the radius around the center"),
+    ))
+    regionCorner1: bpy.props.FloatVectorProperty(name = "Corner", size = 2, default = (0, 0),
+        description = "A corner of the rectangle to import, in blender units")
+    regionCorner2: bpy.props.FloatVectorProperty(name = "Opposite corner", size = 2, default = (500, 500),
+        description = "The opposite corner of the rectangle to import, in blender units")
+    regionCenter: bpy.props.FloatVectorProperty(name = "Center", size = 2, default = (0, 0),
+        description = "Center of the disc to import, in blender units")
+    regionRadius: bpy.props.FloatProperty(name = "Radius", default = 200, min = 0,
+        description = "Radius of the disc to import, in blender units")
+
+    def importRegion(self, unitScale):
+        # The region in game units (unitScale per blender unit) for ultimaFormats, or None for the whole map.
+        if self.regionMode == 'RECTANGLE':
+            return ultimaFormats.rectangleRegion(self.regionCorner1[0] * unitScale, self.regionCorner1[1] * unitScale,
+                self.regionCorner2[0] * unitScale, self.regionCorner2[1] * unitScale)
+        if self.regionMode == 'RADIUS':
+            return ultimaFormats.radiusRegion(self.regionCenter[0] * unitScale, self.regionCenter[1] * unitScale,
+                self.regionRadius * unitScale)
+        return None
+
+###texture detail
+
+class TextureDetailOptions:
+    # Operator options that import textures from one of the smaller levels stored with them, for large imports
+    # where full resolution isn't needed. Mixed into the import operators.
+    textureMipLevel: bpy.props.EnumProperty(name = "Texture resolution", default = '0', items = (
+        ('0', "Full", "Full resolution"),
+        ('1', "1/2", "The mip level of half the width and height"),
+        ('2', "1/4", "The mip level of a quarter of the width and height"),
+        ('3', "1/8", "The mip level of an eighth of the width and height"),
+    ), description = "Import textures from a smaller mip level, textures without it use their smallest one")
+    maxTextureSize: bpy.props.IntProperty(name = "Max texture size", default = 0, min = 0, max = 4096,
+        description = "Import textures from the first mip level at most this many pixels a side, 0 for no limit")
+
+    def textureDetail(self):
+        # (mipLevel, maxSize) for ultimaFormats.loadTextureFrame
+        return int(self.textureMipLevel), self.maxTextureSize
+
+###profiling
+
+profiledDatablocks = ("objects", "meshes", "images", "materials", "collections")
+
+def countDatablocks():
+    return {kind: len(getattr(bpy.data, kind)) for kind in profiledDatablocks}
+
+def reportDirectory():
+    return bpy.utils.user_resource('DATAFILES', path = "ultima9_import_reports", create = True)
+
+class ProfiledRun:
+    # The phase profile (and cProfile capture if asked) of an import, which can run in several calls:
+    # the profile is only current during each call. finish prints a summary and writes a JSON report
+    # (and a .prof file with the cProfile capture) to the user datafiles directory.
+    def __init__(self, name, useCProfile = False):
+        self.name = name
+        self.profile = ultimaProfile.ImportProfile(name)
+        self.before = countDatablocks()
+        self.profiler = cProfile.Profile() if useCProfile else None
+
+    def call(self, function, *arguments):
+        with ultimaProfile.active(self.profile):
+            if self.profiler is not None:
+                return self.profiler.runcall(function, *arguments)
+            return function(*arguments)
+
+    def finish(self):
+        profile = self.profile
+        profile.finish()
+        after = countDatablocks()
+        profile.datablocks = {kind: after[kind] - self.before[kind] for kind in profiledDatablocks}
+        directory = reportDirectory()
+        if self.profiler is not None:
+            profilePath = os.path.join(directory, "{0}-{1}.prof".format(self.name, int(profile.started)))
+            self.profiler.dump_stats(profilePath)
+            profile.notes["cProfile"] = profilePath
+        profile.printSummary()
+        print("profile written to", profile.write(directory))
+
+###modal import
+
+class ModalImport:
+    # Mixin for operators that run an import as a generator from a timer, so that Blender stays responsive.
+    # The import yields (stage, done, total) after each unit of work (an object, a texture, a terrain tile);
+    # each tick runs it for about timeSlice seconds, then shows the progress in the window manager progress
+    # and the status bar. Esc stops it between two units and keeps what was imported so far.
+    # Without a window (background mode) the import runs to the end at once.
+    timeSlice = 0.1 # seconds of import per tick
+    timerInterval = 0.01
+
+    def startImport(self, context, name, steps, useCProfile = False):
+        self.run = ProfiledRun(name, useCProfile)
+        self.steps = steps
+        self.progress = None
+        if context.window is None:
+            try:
+                self.run.call(collections.deque, steps, 0) # exhausts the generator
+            finally:
+                self.run.finish()
+            return {'FINISHED'}
+        windowManager = context.window_manager
+        self.timer = windowManager.event_timer_add(self.timerInterval, window = context.window)
+        windowManager.modal_handler_add(self)
+        windowManager.progress_begin(0, 1)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC' and event.value == 'PRESS':
+            self.endImport(context, cancelled = True)
+            self.report({'WARNING'}, "Import cancelled, what was imported so far is kept")
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+        try:
+            finished = self.run.call(self.advance)
+        except Exception:
+            self.endImport(context, cancelled = True)
+            raise
+        if finished:
+            self.endImport(context)
+            return {'FINISHED'}
+        stage, done, total = self.progress
+        context.window_manager.progress_update(done / total if total > 0 else 0)
+        context.workspace.status_text_set("{0}: {1} of {2} (Esc to cancel)".format(stage, done, total))
+        return {'RUNNING_MODAL'}
+
+    def advance(self):
+        # runs the import for a time slice, True once it is over
+        deadline = time.perf_counter() + self.timeSlice
+        for self.progress in self.steps:
+            if time.perf_counter() >= deadline:
+                return False
+        return True
+
+    def endImport(self, context, cancelled = False):
+        windowManager = context.window_manager
+        windowManager.event_timer_remove(self.timer)
+        windowManager.progress_end()
+        context.workspace.status_text_set(None)
+        if cancelled:
+            self.run.call(self.steps.close) # runs the import's own cleanup, with its phases still profiled
+            self.run.profile.notes["cancelled"] = True
+            print(self.run.name, "cancelled")
+        self.run.finish()
@@ -0,0 +1,1404 @@
+# Readers for the Ultima 9 data formats shared by the model and terrain importers.
+# This module doesn't import bpy, it only turns file contents into plain python values and numpy arrays,
+# so it can also be used from worker processes and standalone tools (see tools/ultimaBenchmark.py).
+# https://wiki.ultimacodex.com/wiki/Ultima_IX_internal_formats
+
+import collections
+import hashlib
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy # bundled with Blender
+
+###FLX archive
+
+archiveHeaderFormat = struct.Struct("<76sIIIIIIIII16s") # Total size is 0x80 bytes.
+
+def readArchiveHeader(buffer, offset = 0):
+    fields = archiveHeaderFormat.unpack_from(buffer, offset)
+    header = dict()
+    header["unused1"] = fields[0]  # = 0x20; // 0x00
+    header["unused2"] = fields[1]  # = 0x00; // 0x4C
+    header["count"] = fields[2]  #; // 0x50 - The number of records.
+    header["unused3"] = fields[3]  # = 0x02; // 0x54 - Perhaps it's a version number.
+    header["size"] = fields[4]  #; // 0x58 - Size in bytes of the archive file.
+    header["size2"] = fields[5]  #; // 0x5C - Also the size in bytes of the archive file.
+    header["unused4"] = fields[6]
+    header["unused4_2"] = fields[7]
+    header["unused5"] = fields[8]  # = 0x01; // 0x68
+    header["unused5_2"] = fields[9]  # an extra to reach 0x80 length
+    header["unused6"] = fields[10]  # = 0x00; // 0x6C
+    return header
+
+class FlxArchive:
+    # The archive file is memory-mapped. The record table (offset, size pairs of 8 bytes each, right after the header)
+    # is decoded with a single unpack, and records are handed out as memoryview slices of the mapping, so nothing is copied.
+    # data is the mmap itself, which can also be used as a read-only file object (seek/read/tell) at absolute offsets.
+    def __init__(self, filePath):
+        self.filePath = filePath
+        stat = os.stat(filePath)
+        self.identity = (stat.st_size, stat.st_mtime_ns)
+        self.file_object = open(filePath, "rb")
+        self.data = mmap.mmap(self.file_object.fileno(), 0, access = mmap.ACCESS_READ)
+        self.view = memoryview(self.data)
+        self.header = readArchiveHeader(self.view)
+        table = struct.unpack_from("<{0}I".format(2 * self.header["count"]), self.view, archiveHeaderFormat.size)
+        self.offsets = table[0::2] # Byte offset from the beginning of the file to the record data.
+        self.sizes = table[1::2] # Size in bytes of the record.
+        # identifies this exact archive for on-disk caches: size, modification time and a hash of the header and record table
+        tableHash = hashlib.blake2b(self.view[:archiveHeaderFormat.size + 8 * self.header["count"]], digest_size = 8).hexdigest()
+        self.fingerprint = "{0}-{1}-{2}".format(stat.st_size, stat.st_mtime_ns, tableHash)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def record(self, index):
+        offset = self.offsets[index]
+        return self.view[offset:offset + self.sizes[index]]
+
+    def close(self):
+        self.view.release()
+        try:
+            self.data.close()
+        except BufferError:
+            pass # record views are still alive somewhere, the mapping goes away with them
+        self.file_object.close()
+
+openArchives = dict()
+
+def openArchive(filePath):
+    # Archives stay mapped between imports (e.g. successive ranged imports of sappear.flx),
+    # and are mapped again when the file changed on disk.
+    key = os.path.realpath(filePath)
+    stat = os.stat(key)
+    archive = openArchives.get(key)
+    if archive is not None and archive.identity != (stat.st_size, stat.st_mtime_ns):
+        archive.close()
+        archive = None
+    if archive is None:
+        archive = FlxArchive(key)
+        openArchives[key] = archive
+    return archive
+
+def mapFile(filePath):
+    # Read-only memory mapping of a whole file, usable as a buffer; only the parts that get read are loaded.
+    # It goes away with the last array viewing it.
+    with open(filePath, "rb") as file_object:
+        return mmap.mmap(file_object.fileno(), 0, access = mmap.ACCESS_READ)
+
+###map regions
+
+# A region limits an import to part of a map. Coordinates are game units, the ones of map object positions:
+# a terrain point is 128 units from the next, a map page covers 4096 units.
+# A region is a rectangle (minX, minY, maxX, maxY), optionally narrowed to a disc by center and radius.
+
+def rectangleRegion(minX, minY, maxX, maxY):
+    region = dict()
+    region["minX"], region["maxX"] = min(minX, maxX), max(minX, maxX)
+    region["minY"], region["maxY"] = min(minY, maxY), max(minY, maxY)
+    region["center"] = None
+    region["radius"] = None
+    return region
+
+def radiusRegion(centerX, centerY, radius):
+    region = rectangleRegion(centerX - radius, centerY - radius, centerX + radius, centerY + radius)
+    region["center"] = (centerX, centerY)
+    region["radius"] = radius
+    return region
+
+def regionIntersects(region, minX, minY, maxX, maxY):
+    # Whether each box (arrays or scalars) touches the region. Points are boxes with min = max.
+    touches = (minX <= region["maxX"]) & (maxX >= region["minX"]) & (minY <= region["maxY"]) & (maxY >= region["minY"])
+    if region["radius"] is not None:
+        centerX, centerY = region["center"]
+        # distance from the center to the closest point of the box
+        distanceX = numpy.clip(centerX, minX, maxX) - centerX
+        distanceY = numpy.clip(centerY, minY, maxY) - centerY
+        touches = touches & (distanceX * distanceX + distanceY * distanceY <= region["radius"] * region["radius"])
+    return touches
+
+###bitmap records
+
+textureSetHeaderFormat = struct.Struct("<HHHHII") # Total size is 0x10 bytes.
+
+def readTextureSetHeader(buffer, offset = 0):
+    fields = textureSetHeaderFormat.unpack_from(buffer, offset)
+    header = dict()
+    header["frameWidth"] = fields[0]  # Maximum width in pixels of all the frames.
+    header["format"] = fields[1] # enum TextureFormat
+    header["frameHeight"] = fields[2]  # Maximum height in pixels of all the frames.
+    header["compression"] = fields[3]  # Uncompressed = 0x00, Unknown = 0x01 (Used with some 8-bit textures)
+    header["count"] = fields[4]  # The number of frames.; u9tools thinks count is 4 bytes, othes specs say 2
+    header["unknown"] = fields[5]  #
+    return header
+
+def readFrameRecords(buffer, count, offset = textureSetHeaderFormat.size):
+    # Frame records follow the texture set header, 8 bytes each.
+    table = struct.unpack_from("<{0}I".format(2 * count), buffer, offset)
+    records = []
+    for i in range(count):
+        record = dict()
+        record["offset"] = table[2 * i] # Offset of the frame relative to the start of the resource.
+        record["length"] = table[2 * i + 1] # Size in bytes of the frame data.
+        records.append(record)
+    return records
+
+frameHeaderFormat = struct.Struct("<HHIIII") # Basic size is 0x14 bytes, followed by one offset per row.
+
+def readFrameHeader(buffer, offset = 0):
+    fields = frameHeaderFormat.unpack_from(buffer, offset)
+    header = dict()
+    header["unknown1"] = fields[0]  #
+    header["unknown2"] = fields[1]  # Usually 0x6000.
+    header["width"] = fields[2] # Width in pixels of the frame.
+    header["height"] = fields[3] # Height in pixels of the frame.
+    header["unknown3"] = fields[4] # Almost always 0.
+    header["unknown4"] = fields[5] # Almost always 0.
+    # Offset to the data for each row relative to the start of the resource.
+    header["offsets"] = struct.unpack_from("<{0}I".format(header["height"]), buffer, offset + frameHeaderFormat.size)
+    return header
+
+def frameHeaderSize(frameHeader):
+    return frameHeaderFormat.size + 4 * frameHeader["height"]
+
+def readTextureFrame(record, frameIndex):
+    # Frame header of one frame of a texture record, completed with what's needed to decode its pixels.
+    textureSetHeader = readTextureSetHeader(record)
+    frameRecord = readFrameRecords(record, textureSetHeader["count"])[frameIndex]
+    frameHeader = readFrameHeader(record, frameRecord["offset"])
+    frameHeader["isTransparent"] = frameHeader["unknown1"] >> 8 & 1 ==1 #unknown1 bit 13 or unknown2 bit 3 are also possible candidates
+    #Determine the bits per pixel by subtracting the frame's size by the total size of the TextureFrameHeader (0x14 + 4 * header.height), 
+    #then dividing by height times width; the result will be 1 or 2
+    #add mipmap sizes too
+    mipSize = frameHeader["width"]*frameHeader["height"]
+    dataSize = mipSize
+    for i in range(textureSetHeader["format"]): #format is actually mip count?
+        mipSize = mipSize/4
+        dataSize += mipSize
+    #if size if all mips assuming 8bpp plus header is equal to record size, texture is indeed 8bpp
+    frameHeader["is8bit"] = frameRecord["length"] - frameHeaderSize(frameHeader) == dataSize
+    frameHeader["pixelOffset"] = frameRecord["offset"] + frameHeaderSize(frameHeader) # relative to the start of the record
+    frameHeader["mipLevel"] = 0
+    # the smaller levels follow the full resolution one, only those the frame is long enough to hold are counted
+    mipLevels = 0
+    end = frameHeader["pixelOffset"] + mipLevelBytes(frameHeader, 0)
+    while mipLevels < textureSetHeader["format"]:
+        end += mipLevelBytes(frameHeader, mipLevels + 1)
+        if end > frameRecord["offset"] + frameRecord["length"]:
+            break
+        mipLevels += 1
+    frameHeader["mipLevels"] = mipLevels
+    return frameHeader
+
+def mipLevelSize(frameHeader, level):
+    return max(frameHeader["width"] >> level, 1), max(frameHeader["height"] >> level, 1)
+
+def mipLevelBytes(frameHeader, level):
+    width, height = mipLevelSize(frameHeader, level)
+    return width * height * (1 if frameHeader["is8bit"] else 2)
+
+def selectMipLevel(frameHeader, mipLevel = 0, maxSize = 0):
+    # The stored level to decode: mipLevel, or the first level no larger than maxSize pixels a side if that one is smaller,
+    # within the levels the frame has.
+    level = mipLevel
+    if maxSize > 0:
+        while max(mipLevelSize(frameHeader, level)) > maxSize and level < frameHeader["mipLevels"]:
+            level += 1
+    return min(level, frameHeader["mipLevels"])
+
+def mipLevelFrame(frameHeader, level):
+    # The frame header of a full resolution frame (from readTextureFrame) turned into one of its mip level,
+    # with the size and pixel offset of that level, for decodeFramePixels.
+    levelHeader = dict(frameHeader)
+    levelHeader["pixelOffset"] += sum(mipLevelBytes(frameHeader, i) for i in range(level))
+    levelHeader["width"], levelHeader["height"] = mipLevelSize(frameHeader, level)
+    levelHeader["mipLevel"] = level
+    return levelHeader
+
+def decodeFramePixels(record, frameHeader):
+    # Decodes the level of a frame its header describes (the full resolution one unless it comes from mipLevelFrame)
+    # into a flat float32 RGBA array, in the row order of the file, ready for image.pixels.foreach_set.
+    pixelCount = frameHeader["width"] * frameHeader["height"]
+    pixels = numpy.empty((pixelCount, 4), dtype = numpy.float32)
+    if frameHeader["is8bit"] == True: #we assume any 8bit material in texture16 is alpha blended
+        rawColors = numpy.frombuffer(record, dtype = numpy.uint8, count = pixelCount, offset = frameHeader["pixelOffset"])
+        pixels[:] = (rawColors / 255)[:, None] # monochrome, alpha included
+        return pixels.ravel()
+    rawColors = numpy.frombuffer(record, dtype = "<u2", count = pixelCount, offset = frameHeader["pixelOffset"])
+    if frameHeader["isTransparent"] == False: # 565
+        pixels[:, 0] = ((rawColors >> 11) & 0b11111) / 31 # Shift 11, mask 0xF800.
+        pixels[:, 1] = ((rawColors >> 5) & 0b111111) / 63 # Shift 5, mask 0x7E0.
+        pixels[:, 2] = (rawColors & 0b11111) / 31 # Shift 0, mask 31.
+        pixels[:, 3] = 1.0
+    else: # 5551
+        pixels[:, 0] = ((rawColors >> 10) & 0b11111) / 31 # Shift 10, mask 0x7C00.
+        pixels[:, 1] = ((rawColors >> 5) & 0b11111) / 31 # Shift 5, mask 0x3E0.
+        pixels[:, 2] = (rawColors & 0b11111) / 31 # Shift 0, mask 31.
+        pixels[:, 3] = rawColors >> 15 # Shift 15, mask 0x8000.
+    return pixels.ravel()
+
+def loadTextureFrame(archive, textureIndex, frameIndex, textureCache = None, mipLevel = 0, maxSize = 0):
+    # Returns the frame description (width, height, isTransparent, is8bit) and its decoded pixels,
+    # from the cache when possible. mipLevel and maxSize pick a smaller level stored in the frame (see selectMipLevel),
+    # which is then the only one read and decoded.
+    record = None
+    level = 0
+    if mipLevel > 0 or maxSize > 0:
+        # the level depends on the frame size and on the levels it has, both in its header
+        record = archive.record(textureIndex)
+        frameHeader = readTextureFrame(record, frameIndex)
+        level = selectMipLevel(frameHeader, mipLevel, maxSize)
+    if textureCache is not None:
+        cached = textureCache.load(textureIndex, frameIndex, level)
+        if cached is not None:
+            return cached
+    if record is None:
+        record = archive.record(textureIndex)
+        frameHeader = readTextureFrame(record, frameIndex)
+    if level > 0:
+        frameHeader = mipLevelFrame(frameHeader, level)
+    pixels = decodeFramePixels(record, frameHeader)
+    if textureCache is not None:
+        textureCache.store(textureIndex, frameIndex, frameHeader, pixels, level)
+    return frameHeader, pixels
+
+def decodeTextureFrames(archive, frames, textureCache = None, workers = None, mipLevel = 0, maxSize = 0, prefetch = None):
+    # Decodes the (texture, frame) pairs of frames with loadTextureFrame on a pool of threads (one per core by default),
+    # all reading the same memory-mapped archive; the pixel conversion runs in numpy, which releases the GIL.
+    # Yields ((texture, frame), (frameHeader, pixels)) in the order of frames. mipLevel and maxSize go to loadTextureFrame.
+    # Frames a TexturePrefetch of the same decodes already started are taken from it.
+    return mapTextureFrames(loadTextureFrame, archive, frames, workers, textureCache, mipLevel, maxSize, prefetch = prefetch)
+
+def mapTextureFrames(function, archive, frames, workers, *arguments, prefetch = None):
+    # Runs function(archive, texture, frame, *arguments) for the (texture, frame) pairs of frames on a pool of threads,
+    # yielding ((texture, frame), result) in the order of frames, with at most a few frames per thread
+    # done ahead of the consumer so that memory use stays bounded. The frames prefetch (a TexturePrefetch running
+    # the same function) holds are taken from it instead.
+    frames = list(frames)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(frames) <= 1:
+        for textureIndex, frameIndex in frames:
+            future = prefetch.take((textureIndex, frameIndex)) if prefetch is not None else None
+            if future is not None:
+                yield (textureIndex, frameIndex), future.result()
+            else:
+                yield (textureIndex, frameIndex), function(archive, textureIndex, frameIndex, *arguments)
+        return
+    window = workers * 4
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        pending = collections.deque()
+        try:
+            for textureIndex, frameIndex in frames:
+                future = prefetch.take((textureIndex, frameIndex)) if prefetch is not None else None
+                if future is None:
+                    future = executor.submit(function, archive, textureIndex, frameIndex, *arguments)
+                pending.append(((textureIndex, frameIndex), future))
+                if len(pending) >= window:
+                    key, future = pending.popleft()
+                    yield key, future.result()
+            while pending:
+                key, future = pending.popleft()
+                yield key, future.result()
+        finally:
+            # when the consumer stops early, frames not started yet are dropped rather than done for nothing
+            for key, future in pending:
+                future.cancel()
+
+defaultPrefetchBytes = 256 * 1024 * 1024
+
+def decodedFrameBytes(archive, textureIndex, frameIndex, mipLevel = 0, maxSize = 0):
+    # the size of the pixels loadTextureFrame decodes for a frame, from its header alone
+    frameHeader = readTextureFrame(archive.record(textureIndex), frameIndex)
+    width, height = mipLevelSize(frameHeader, selectMipLevel(frameHeader, mipLevel, maxSize))
+    return width * height * 4 * 4 # float32 RGBA
+
+class TexturePrefetch:
+    # Starts function(archive, texture, frame, *arguments) for the frames of an import on a pool of threads as soon as
+    # they are known, so that they are done while the import does other things; mapTextureFrames then takes them
+    # from here. With frameBytes (a function of archive, texture and frame), frames stop being started once their
+    # results would take more than maxBytes, the others are left to mapTextureFrames.
+    # close must be called once the import is over, it drops whatever was not taken.
+    def __init__(self, function, archive, frames, arguments = (), workers = None, frameBytes = None, maxBytes = defaultPrefetchBytes):
+        self.executor = ThreadPoolExecutor(max_workers = workers or os.cpu_count() or 1)
+        self.futures = dict() # (texture, frame): future
+        totalBytes = 0
+        for textureIndex, frameIndex in frames:
+            if frameBytes is not None:
+                try:
+                    totalBytes += frameBytes(archive, textureIndex, frameIndex)
+                except (struct.error, IndexError):
+                    continue # a broken frame, reported when it is loaded
+                if totalBytes > maxBytes:
+                    break
+            self.futures[(textureIndex, frameIndex)] = self.executor.submit(function, archive, textureIndex, frameIndex, *arguments)
+
+    def __len__(self):
+        return len(self.futures)
+
+    def take(self, frame):
+        # the future of frame if it was started here, which then isn't held here any more
+        return self.futures.pop(frame, None)
+
+    def close(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+        self.executor.shutdown(wait = False)
+
+###texture atlases
+
+def packTextureAtlases(frames, maxSize = 4096, padding = 4):
+    # Packs decoded frames, a list of (frameHeader, pixels) from loadTextureFrame, into as few atlases as fit in maxSize
+    # pixels a side. Frames sit in a grid of equal cells, surrounded by padding pixels repeating their edges so that
+    # filtering doesn't bleed the neighbours in.
+    # Returns the atlases as (height, width, 4) float32 arrays in the row order of blender images, and for each frame
+    # its placement (atlas index, (u0, v0, u1, v1)) in normalized atlas coordinates.
+    cellWidth = max(frameHeader["width"] for frameHeader, pixels in frames) + 2 * padding
+    cellHeight = max(frameHeader["height"] for frameHeader, pixels in frames) + 2 * padding
+    columns = max(maxSize // cellWidth, 1)
+    capacity = columns * max(maxSize // cellHeight, 1)
+    atlases = []
+    placements = []
+    for start in range(0, len(frames), capacity):
+        count = min(capacity, len(frames) - start)
+        atlasColumns = min(columns, count)
+        atlasRows = -(-count // atlasColumns)
+        atlasWidth, atlasHeight = atlasColumns * cellWidth, atlasRows * cellHeight
+        atlas = numpy.zeros((atlasHeight, atlasWidth, 4), dtype = numpy.float32)
+        for i, (frameHeader, pixels) in enumerate(frames[start:start + count]):
+            width, height = frameHeader["width"], frameHeader["height"]
+            x = i % atlasColumns * cellWidth
+            y = i // atlasColumns * cellHeight
+            atlas[y:y + height + 2 * padding, x:x + width + 2 * padding] = numpy.pad(pixels.reshape(height, width, 4),
+                ((padding, padding), (padding, padding), (0, 0)), mode = "edge")
+            x += padding
+            y += padding
+            placements.append((len(atlases), (x / atlasWidth, y / atlasHeight, (x + width) / atlasWidth, (y + height) / atlasHeight)))
+        atlases.append(atlas)
+    return atlases, placements
+
+def remapAtlasUVs(UVs, materialIDs, slotPlacements):
+    # Moves per loop UVs (three loops per face) from whole textures into their place in the atlases,
+    # slotPlacements being the placement of the frame of each material slot. Any rotation of the UVs within a face is kept.
+    # Returns the new UVs, the new material slot of each face and the atlases these slots stand for.
+    rectangles = numpy.array([rectangle for atlas, rectangle in slotPlacements], dtype = numpy.float32).reshape(-1, 4)
+    slotAtlases = numpy.array([atlas for atlas, rectangle in slotPlacements], dtype = numpy.int32)
+    loopRectangles = rectangles[numpy.repeat(materialIDs, 3)]
+    atlasUVs = loopRectangles[:, :2] + UVs * (loopRectangles[:, 2:] - loopRectangles[:, :2])
+    usedAtlases, atlasIDs = numpy.unique(slotAtlases[materialIDs], return_inverse = True)
+    return atlasUVs, atlasIDs.astype(numpy.int32), usedAtlases.tolist()
+
+###decoded texture cache
+
+cachedFrameHeaderFormat = struct.Struct("<4sIII??") # magic, version, width, height, isTransparent, is8bit
+cachedFrameMagic = b"U9TX"
+cachedFrameVersion = 1
+defaultTextureCacheSize = 512 * 1024 * 1024
+
+class TextureCache:
+    # Decoded frames of one archive, stored as raw float32 RGBA files under directory/<archive name>-<fingerprint>/,
+    # one per mip level decoded.
+    # The least recently used entries (by file modification time, refreshed on every hit) of all the archives cached
+    # in directory are evicted when their total size goes over maxBytes. Directories of other archives, or of older
+    # versions of this one, are left alone: two installs with an archive of the same name each keep their own entries,
+    # and those of an archive no longer used are the oldest ones, evicted first.
+    # Entries can be loaded and stored from several threads at once.
+    def __init__(self, directory, archive, maxBytes = defaultTextureCacheSize):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock() # guards totalBytes and eviction
+        self.path = os.path.join(directory, "{0}-{1}".format(os.path.basename(archive.filePath), archive.fingerprint))
+        os.makedirs(self.path, exist_ok = True)
+        self.totalBytes = 0
+        for otherPath in self.archiveDirectories():
+            for entry in os.scandir(otherPath):
+                self.totalBytes += entry.stat().st_size
+
+    def archiveDirectories(self):
+        # the size cap is shared by every archive cached in the directory
+        return [entry.path for entry in os.scandir(self.directory) if entry.is_dir()]
+
+    def entryPath(self, textureIndex, frameIndex, mipLevel = 0):
+        if mipLevel > 0:
+            return os.path.join(self.path, "{0}_{1}_mip{2}.u9tex".format(textureIndex, frameIndex, mipLevel))
+        return os.path.join(self.path, "{0}_{1}.u9tex".format(textureIndex, frameIndex))
+
+    def load(self, textureIndex, frameIndex, mipLevel = 0):
+        path = self.entryPath(textureIndex, frameIndex, mipLevel)
+        try:
+            with open(path, "rb") as file_object:
+                magic, version, width, height, isTransparent, is8bit = cachedFrameHeaderFormat.unpack(
+                    file_object.read(cachedFrameHeaderFormat.size))
+                if magic != cachedFrameMagic or version != cachedFrameVersion:
+                    return None
+                pixels = numpy.fromfile(file_object, dtype = numpy.float32, count = width * height * 4)
+            if len(pixels) != width * height * 4:
+                return None # truncated entry, it will be overwritten
+            os.utime(path) # mark as recently used
+        except (OSError, struct.error):
+            return None
+        frame = dict()
+        frame["width"] = width
+        frame["height"] = height
+        frame["isTransparent"] = isTransparent
+        frame["is8bit"] = is8bit
+        frame["mipLevel"] = mipLevel
+        return frame, pixels
+
+    def store(self, textureIndex, frameIndex, frameHeader, pixels, mipLevel = 0):
+        path = self.entryPath(textureIndex, frameIndex, mipLevel)
+        temporaryPath = path + ".tmp"
+        try:
+            with open(temporaryPath, "wb") as file_object:
+                file_object.write(cachedFrameHeaderFormat.pack(cachedFrameMagic, cachedFrameVersion,
+                    frameHeader["width"], frameHeader["height"], frameHeader["isTransparent"], frameHeader["is8bit"]))
+                pixels.astype(numpy.float32, copy = False).tofile(file_object)
+            try:
+                replacedBytes = os.path.getsize(path) # an entry stored again, like a truncated one
+            except OSError:
+                replacedBytes = 0
+            os.replace(temporaryPath, path)
+        except OSError:
+            return # caching is best effort
+        with self.lock:
+            self.totalBytes += os.path.getsize(path) - replacedBytes
+            if self.totalBytes > self.maxBytes:
+                self.evict()
+
+    def evict(self):
+        entries = []
+        for otherPath in self.archiveDirectories():
+            for entry in os.scandir(otherPath):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue # replaced or removed meanwhile
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        entries.sort()
+        self.totalBytes = sum(size for _, size, _ in entries)
+        target = self.maxBytes * 3 // 4 # leave some room so eviction doesn't run on every store
+        for _, size, path in entries:
+            if self.totalBytes <= target:
+                break
+            try:
+                os.remove(path)
+                self.totalBytes -= size
+            except OSError:
+                pass
+
+###external texture files
+
+tgaHeaderFormat = struct.Struct("<BBBHHBHHHHBB") # Total size is 0x12 bytes.
+
+def tgaColors(pixels):
+    # (height, width, 4) float RGBA pixels to the BGRA bytes of a TGA file
+    colors = numpy.empty(pixels.shape, dtype = numpy.uint8)
+    colors[..., [2, 1, 0, 3]] = numpy.rint(numpy.clip(pixels, 0, 1) * 255)
+    return colors
+
+def writeTGA(path, colors):
+    # Writes (height, width, 4) BGRA colors from tgaColors, bottom row first like blender images, as an uncompressed
+    # 32 bit TGA, which blender reads without any decompression. The file appears complete or not at all.
+    height, width = colors.shape[:2]
+    temporaryPath = path + ".tmp"
+    with open(temporaryPath, "wb") as file_object:
+        # no ID, no palette, true color; bottom left origin and 8 alpha bits in the descriptor
+        file_object.write(tgaHeaderFormat.pack(0, 0, 2, 0, 0, 0, 0, 0, width, height, 32, 8))
+        colors.tofile(file_object)
+    os.replace(temporaryPath, path)
+
+class TextureFiles:
+    # Frames of one archive written as TGA files under directory/<archive name>-<fingerprint>/, for blender to use as
+    # external images instead of packing them into the .blend file. A frame is only decoded the first time it is needed,
+    # after that its file is used as it is. Files are never removed here, saved .blend files refer to them.
+    def __init__(self, directory, archive):
+        self.path = os.path.join(directory, "{0}-{1}".format(os.path.basename(archive.filePath), archive.fingerprint))
+        os.makedirs(self.path, exist_ok = True)
+
+    def framePath(self, textureIndex, frameIndex, mipLevel = 0):
+        if mipLevel > 0:
+            return os.path.join(self.path, "{0}_{1}_mip{2}.tga".format(textureIndex, frameIndex, mipLevel))
+        return os.path.join(self.path, "{0}_{1}.tga".format(textureIndex, frameIndex))
+
+    def writeImage(self, name, pixels):
+        # For images made by the importers, like texture atlases. The file is named after the content too, so that
+        # a later import making another image under the same name doesn't change the one earlier .blend files use.
+        colors = tgaColors(pixels)
+        path = os.path.join(self.path, "{0}-{1}.tga".format(name, hashlib.blake2b(colors, digest_size = 8).hexdigest()))
+        if not os.path.exists(path):
+            writeTGA(path, colors)
+        return path
+
+def exportTextureFrame(archive, textureIndex, frameIndex, textureFiles, mipLevel = 0, maxSize = 0):
+    # Writes the file of a frame, at the level mipLevel and maxSize pick (see selectMipLevel), unless it is there already.
+    # Returns the frame description (width, height, isTransparent, is8bit), the path of the file and whether it was written.
+    record = archive.record(textureIndex)
+    frameHeader = readTextureFrame(record, frameIndex)
+    level = selectMipLevel(frameHeader, mipLevel, maxSize)
+    if level > 0:
+        frameHeader = mipLevelFrame(frameHeader, level)
+    path = textureFiles.framePath(textureIndex, frameIndex, level)
+    if os.path.exists(path):
+        return frameHeader, path, False
+    pixels = decodeFramePixels(record, frameHeader)
+    writeTGA(path, tgaColors(pixels.reshape(frameHeader["height"], frameHeader["width"], 4)))
+    return frameHeader, path, True
+
+def exportTextureFrames(archive, frames, textureFiles, workers = None, mipLevel = 0, maxSize = 0, prefetch = None):
+    # exportTextureFrame for the (texture, frame) pairs of frames on a pool of threads, like decodeTextureFrames.
+    # Yields ((texture, frame), (frameHeader, path, written)) in the order of frames.
+    return mapTextureFrames(exportTextureFrame, archive, frames, workers, textureFiles, mipLevel, maxSize, prefetch = prefetch)
+
+###types.dat
+
+typesHeaderSize = 0x8 # types actually begin at 8h
+
+typeDtype = numpy.dtype([
+    ("unknown1", "<u4"), # ??  Either 0 or CDCDCDCDh, with no apparent reason.
+    ("UsecodeID", "<u2"), # Refers to an entry in the usecode list, which is within the game engine.
+    ("DefaultModelID", "<u2"), # Refers to a model entry in the "static/sappear.flx". 
+    # This model ID is used by default but the model ID used per instance in the nonfixed map file takes priority.
+    ("Type Flags", "<u2"), # Each bit of this word is a separate type flag: 
+    # Never Hidden(0x01), NPC Only Collision(0x02), Partial Collision(0x04), Non Camera Block (see Spaces FLX)(0x08),
+    # Portal Block (see Spaces FLX)(0x10), Unique Model (Final Art I'm guessing for the modelers)(0x20), ??(0x40), Not used, 
+    # Vestigial(0x80), Mesh Collision(0x0100)
+    ("Weight", "u1"), # Weight used for Physics gravity, FF are not player movable, FE appears to be the same
+    ("Volume", "u1"), # Probably used for collision cylinder
+    ("BookNumber", "u1"), # Vestigial parameter, may not even be recognized by the engine.
+    ("Hitpoints", "u1"), # Vestigial parameter, handled with NPC.flx or type's instance nonfixed property.
+    ("unknown2", "<u2"), # ??  Always 0.
+]) # 16 bytes
+
+def readTypes(buffer):
+    # All the type entries of a types.dat file, indexed by type ID. A trailing partial entry is ignored.
+    count = max(len(buffer) - typesHeaderSize, 0) // typeDtype.itemsize
+    return numpy.frombuffer(buffer, dtype = typeDtype, count = count, offset = typesHeaderSize)
+
+def readTypeModels(buffer):
+    # Default model ID of each type, as a list indexed by type ID.
+    return readTypes(buffer)["DefaultModelID"].tolist()
+
+###palette
+
+def readPalette(buffer):
+    # static/ankh.pal is 256 * 4 bytes for the whole palette, BGR plus an ignored byte for each color.
+    # Returns a (256, 4) float32 RGBA array, fully opaque.
+    colors = numpy.frombuffer(buffer, dtype = numpy.uint8, count = 256 * 4).reshape(256, 4)
+    palette = numpy.ones((256, 4), dtype = numpy.float32)
+    palette[:, :3] = colors[:, 2::-1] / 255
+    return palette
+
+###fixed objects
+
+fixedHeaderFormat = struct.Struct("<8I") # Total size is 0x20 bytes.
+
+def readFixedHeader(buffer, offset = 0):
+    fields = fixedHeaderFormat.unpack_from(buffer, offset)
+    header = dict()
+    header["unknown1"] = fields[0]  # ??  
+    header["unknown2"] = fields[1]  # ??  
+    header["pagesSize"] = fields[2]  # The size in bytes of all the pages.
+    header["unknown3"] = fields[3]  # ??  
+    header["width"] = fields[4]  # The number of tiles the region is wide. This is the same as the terrain height map's width divided by two.
+    header["height"] = fields[5]  # The number of tiles the region is tall. This is the same as the terrain height map's height divided by two.
+    header["unknown4"] = fields[6]  #??
+    header["unknown5"] = fields[7]  #
+    return header
+
+fixedObjectDtype = numpy.dtype([
+    ("reference", "<u4"), # A byte offset from the start of the file to another object, or 0. 
+    # Some objects have invalid references, and some are circular.
+    ("position", "<u2", 3), # The location of the object within the tile, 
+    # between 0 and 4095. This means that for each terrain quad there are 128 discrete positions.
+    ("type", "<u2"), # The type index.
+    ("angle", "<i2", 4), # Angle of the fixed stored in 0.16 fixed point as a normalized quaternion. 
+    # compute the angle as Quaternion(x / 32767.0, y / 32767.0, z / 32767.0, w / 32767.0).
+    ("Flags", "<i2"), # Flags for the object. 16 bit further than the specs, that were missing W component of quaternion
+    ("unknown", "<u2"), # ? 
+]) # 24 bytes
+
+fixedPageObjectCount = 166 # always 166 entries
+fixedPageDtype = numpy.dtype([
+    ("unknown1", "<u4", 3), #??  
+    ("baseX", "<u4"), # The base X coordinate to add to the X coordinate of all objects in the page.
+    ("baseY", "<u4"), # The base Y coordinate to add to the Y coordinate of all objects in the page.
+    ("unknown2", "u1", 4 * 0x13), # ??  
+    ("objects", fixedObjectDtype, fixedPageObjectCount),
+    ("padding", "u1", 0x10), # Padding to a 1000h (4096)-byte boundary.
+])
+
+mapPageExtent = 4096 # game units covered by a fixed or nonfixed page, from its baseX, baseY
+
+def pagesInRegion(pages, region):
+    # Pages are only located by the base coordinates in their header, so only those are read to select them.
+    baseX = pages["baseX"].astype(numpy.int64)
+    baseY = pages["baseY"].astype(numpy.int64)
+    return regionIntersects(region, baseX, baseY, baseX + mapPageExtent, baseY + mapPageExtent)
+
+def readFixedObjects(buffer, region = None):
+    # Reads all the pages of a fixed file at once and returns the header and a table of the objects,
+    # as a dict of arrays with one row per object, in file order. Empty slots (type 0) are left out.
+    # Besides the fields of the entries, the table has "page", "worldPosition" in game units and "orientation" as normalized
+    # (x, y, z, w) quaternions.
+    # With a region, only the pages that touch it are decoded, and only the objects inside it are kept.
+    header = readFixedHeader(buffer)
+    pageCount = header["width"] * header["height"]
+    # These are either 0 or a number in the form nnnn001h, where nnnn is a number that may be a page index
+    indices = numpy.frombuffer(buffer, dtype = "<u4", count = pageCount, offset = fixedHeaderFormat.size)
+    pagesStart = fixedHeaderFormat.size + indices.nbytes
+    pageCount = min(pageCount, (len(buffer) - pagesStart) // fixedPageDtype.itemsize) # truncated files stop at the last whole page
+    pages = numpy.frombuffer(buffer, dtype = fixedPageDtype, count = pageCount, offset = pagesStart)
+    pageIndices = numpy.arange(pageCount)
+    if region is not None:
+        pageIndices = numpy.nonzero(pagesInRegion(pages, region))[0]
+        pages = pages[pageIndices]
+    return header, objectTable(pages, pages["objects"], pageIndices = pageIndices, region = region)
+
+def objectTable(pages, objects, angleField = "angle", used = None, pageIndices = None, region = None):
+    # objects is a (page, slot) array of entries, empty ones being type 0. used optionally masks out more slots.
+    # pageIndices gives the index in the file of each of pages, when they're only some of them.
+    valid = objects["type"] != 0
+    if used is not None:
+        valid &= used
+    page, slot = numpy.nonzero(valid)
+    worldPosition = objects["position"][page, slot].astype(numpy.float64)
+    worldPosition[:, 0] += pages["baseX"][page]
+    worldPosition[:, 1] += pages["baseY"][page]
+    if region is not None:
+        inside = regionIntersects(region, worldPosition[:, 0], worldPosition[:, 1], worldPosition[:, 0], worldPosition[:, 1])
+        page, slot, worldPosition = page[inside], slot[inside], worldPosition[inside]
+    entries = objects[page, slot]
+    table = dict()
+    for name in entries.dtype.names:
+        table[name] = entries[name]
+    table["page"] = page if pageIndices is None else pageIndices[page]
+    table["worldPosition"] = worldPosition
+    table["orientation"] = entries[angleField] / 32767
+    return table
+
+###nonfixed objects
+
+nonfixedHeaderFormat = struct.Struct("<8I")
+
+def readNonfixedHeader(buffer, offset = 0):
+    fields = nonfixedHeaderFormat.unpack_from(buffer, offset)
+    header = dict()
+    header["unknown1"] = fields[0]  # ??  
+    header["unknown2"] = fields[1]  # ??
+    header["unknown3"] = fields[2]  # ?? 
+    header["unknown4"] = fields[3]  # ?? 
+    header["unknown5"] = fields[4]  # ?? 
+    header["width"] = fields[5]  # Width of the region in chunks
+    header["height"] = fields[6]  # height of the region in chunks.
+    header["unknown4"] = fields[7]  # ??
+    pageCount = header["width"] * header["height"]
+    # Byte offset of the first page in the chunk, relative to the end of the header.
+    header["pageOffsets"] = numpy.frombuffer(buffer, dtype = "<u4", count = pageCount, offset = offset + nonfixedHeaderFormat.size)
+    header["unknown6"] = struct.unpack_from("<I", buffer, offset + nonfixedHeaderFormat.size + 4 * pageCount)[0]  #??
+    header["size"] = nonfixedHeaderFormat.size + 4 * pageCount + 4
+    return header
+
+nonfixedObjectDtype = numpy.dtype([
+    ("nextEntity", "<u2"), # Offset to the next entity in a linked list.
+    ("unknown", "<u2"), #
+    ("position", "<u2", 3), #The location of the object within the tile
+    # X offset of the entity relative to the chunk's baseX value.
+    # Y offset of the entity relative to the chunk's baseY value.
+    # Z position of the entity; the elevation.
+    ("type", "<u2"), # Type index.
+    ("rotation", "<i2", 4), # Rotation of the entity expressed as an 0.16 quaternion (divide integer values by 32767).
+    ("Flags", "<u4"), # Entity flags.
+    ("meshIndex", "<u2"), # The mesh index to render for this entity.
+    ("triggerId", "<u2"), #
+    ("extraDataOffset", "<u4"), # Offset of the extra data, relative to the end of the file header.
+]) # 32 bytes
+
+nonfixedPageObjectCount = 125 # as many entities as fit in a page
+nonfixedPageDtype = numpy.dtype([
+    ("nextPage", "<u4"), # Offset of the next page in this chunk, relative to the end of the header minus 1, or 0 for none.
+    ("endEntityOffset", "<u4"), # 
+    ("endTriggerOffset", "<u4"), #    
+    ("baseX", "<u4"), # Base X coordinate of the chunk.
+    ("baseY", "<u4"), # Base Y coordinate of the chunk.
+    ("entityCount", "<u4"), # Number of entities in the chunk.
+    ("triggerCount", "<u4"), # Number of triggers in the chunk.
+    ("unknown", "<u4", 17), # Further offsets to either entities or extra data. (It's not currently clear how to distinguish them.)
+    ("objects", nonfixedObjectDtype, nonfixedPageObjectCount),
+]) # 4096 bytes
+
+def readNonfixedObjects(buffer, region = None):
+    # Reads all the pages of a nonfixed file at once and returns the header, a table of the entities like readFixedObjects does,
+    # and the extra data of the entities, which is only decoded when asked for. A region works like for readFixedObjects.
+    header = readNonfixedHeader(buffer)
+    pageCount = header["width"] * header["height"]
+    pageCount = min(pageCount, (len(buffer) - header["size"]) // nonfixedPageDtype.itemsize) # truncated files stop at the last whole page
+    pages = numpy.frombuffer(buffer, dtype = nonfixedPageDtype, count = pageCount, offset = header["size"])
+    pageIndices = numpy.arange(pageCount)
+    if region is not None:
+        pageIndices = numpy.nonzero(pagesInRegion(pages, region))[0]
+        pages = pages[pageIndices]
+    used = numpy.arange(nonfixedPageObjectCount) < pages["entityCount"][:, None]
+    table = objectTable(pages, pages["objects"], "rotation", used, pageIndices, region)
+    return header, table, NonfixedExtraData(buffer, table["extraDataOffset"])
+
+class NonfixedExtraData:
+    # Extra data of each entity of a nonfixed table (by row), decoded on first access.
+    # It's a list of arguments, each made of three type bytes and three 32 bit values, or None for entities without any.
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.decoded = dict()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, row):
+        if row not in self.decoded:
+            offset = int(self.offsets[row])
+            self.decoded[row] = readExtraData(self.buffer, offset) if offset != 0 else None
+        return self.decoded[row]
+
+def readExtraData(buffer, offset):
+    argCount = buffer[offset]
+    data = []
+    for i in range(argCount):
+        fields = struct.unpack_from("<3B3I", buffer, offset + 1 + 15 * i)
+        entry = dict()
+        entry["types"] = fields[0:3]
+        entry["arguments"] = fields[3:6]
+        data.append(entry)
+    return data
+
+###models
+
+modelHeaderFormat = struct.Struct("<II3fff3fff3f3f4I3ff36sf") # Total size is 144 bytes.
+
+def readModelHeader(buffer, offset = 0):
+    fields = modelHeaderFormat.unpack_from(buffer, offset)
+    header = dict()
+    header["Submesh Count"] = fields[0]  # Number of submeshes.
+    header["LOD Count"] = fields[1]  # Number of level-of-detail stages.
+    header["Cylinder Base Centre"] = fields[2:5]  # Centre of the Cylinder Base.
+    header["Cylinder Base Height"] = fields[5]  # The height of the Cylinder
+    header["Cylinder Base Radius"] = fields[6]  # The radius of the Cylinder.
+    header["Sphere Center"] = fields[7:10]  #C enter of Sphere
+    header["Sphere Radius"] = fields[10]  # Radius of the Sphere
+    header["unknown1"] = fields[11]  # ??
+    header["Minimum Bounds"] = fields[12:15]  # Minimum bounds of a bounding box for the mesh.
+    header["Maximum bounds"] = fields[15:18]  # Maximum bounds of a bounding box for the mesh.
+    header["LOD Threshold 0"] = fields[18]  # Thresholds 0
+    header["LOD Threshold 1"] = fields[19]  # Thresholds 1
+    header["LOD Threshold 2"] = fields[20]  # Thresholds 2
+    header["LOD Threshold 3"] = fields[21]  # Thresholds 3
+    header["Center of Mass"] = fields[22:25]  #  Center of Mass
+    header["Mass or Volume"] = fields[25]  # Mass or Volume? ??
+    header["Inertia Matrix"] = fields[26] # 3x3 Matrix for the inertia for the model
+    header["Inertia related"] = fields[27]  # Inertia related?    Usually 1 or close to zero.
+    return header
+
+boneHeaderFormat = struct.Struct("<II3f3f4f") # Total size is 48 bytes.
+
+def readSubmeshBoneHeader(buffer, offset = 0): # technically a bone
+    fields = boneHeaderFormat.unpack_from(buffer, offset)
+    header = dict()
+    header["Limb ID"] = fields[0]  # The ID of this submesh
+    header["Parent ID"] = fields[1]  # The ID of the parent mesh
+    header["Scale X"] = fields[2]  # Scale of the submesh in the X direction
+    header["Scale Y"] = fields[3]  # Scale of the submesh in the Y direction
+    header["Scale Z"] = fields[4]  # Scale of the submesh in the Z direction
+    header["Position"] = fields[5:8]  # Position/Offset coordinates to parent mesh
+    header["Orientation W"] = fields[8]  # Rotation Scalar
+    header["Orientation X"] = fields[9]  # Rotation X
+    header["Orientation Y"] = fields[10]  # Rotation Y
+    header["Orientation Z"] = fields[11]  # Rotation Z
+    return header
+
+def readModelHierarchy(record):
+    # Model header and bones of a sappear.flx record. The header is followed by, for each bone, the offset of its
+    # header then the offsets of its (LOD Count) submeshes, all relative to the start of the record.
+    # Each bone is its header, with the submesh offsets added as "lods".
+    header = readModelHeader(record)
+    stride = 1 + header["LOD Count"]
+    offsets = struct.unpack_from("<{0}I".format(header["Submesh Count"] * stride), record, modelHeaderFormat.size)
+    bones = []
+    for i in range(header["Submesh Count"]):
+        bone = readSubmeshBoneHeader(record, offsets[i * stride])
+        bone["lods"] = offsets[i * stride + 1:(i + 1) * stride]
+        bones.append(bone)
+    return header, bones
+
+###model submeshes
+
+submeshHeaderFormat = struct.Struct("<III3ff3f3f" + "I" * 13 + "4II") # Total size is 124 bytes.
+submeshHeaderNames = ("Mesh Size", # The size of the submesh in bytes, excluding this value, or 0 if there is no such submesh at this LOD level.
+    "Flags", # Appears to be a bitmask, with 4 and 8 being most common.
+    "unknown1", # Unused?
+    "Sphere Center", # LOD level's sphere center
+    "Sphere Radius", # LOD level's sphere radius
+    "Minimum Bounds", # Minimum bounding box.
+    "Maximum Bounds", # Maximum bounding box.
+    "unknown2", "unknown3", # ignorable
+    "Face Count", # Number of faces in the submesh.
+    "Mount Face Count",
+    "Vertex Count", # Number of vertices in the submesh.
+    "Mount Vertex Count",
+    "Max Face Count",
+    "Material Count", # Number of materials.
+    "Face Offset", # Offset of the faces relative to the start of the detail level plus 4.
+    "Mount Face Offset",
+    "Vertex Offset", # Offset of the vertices relative to the start of the detail level plus 4.
+    "Mount Vertex Offset",
+    "Material Offset", # Offset of the materials relative to the start of the detail level plus 4.
+    "Sorted Faces Offset",
+    "unknown4") # probably unused
+
+def readSubmeshHeader(buffer, offset = 0):
+    fields = submeshHeaderFormat.unpack_from(buffer, offset)
+    # group the vector fields back together
+    values = list(fields[:3]) + [fields[3:6], fields[6], fields[7:10], fields[10:13]] + list(fields[13:26]) + [fields[26:30], fields[30]]
+    return dict(zip(submeshHeaderNames, values))
+
+pointDtype = numpy.dtype([
+    ("index", "<u4"), # Point index
+    ("offset", "<u4"), # Offset to the point in bytes
+    ("normal", "<f4", 3), # Normal  Not always a unit vector
+    ("texCoord", "<f4", 2), # UV coordinates
+])
+
+faceDtype = numpy.dtype([
+    ("Points", pointDtype, 3), # Points in the face
+    ("Flags", "<u4"), # only first 12 bits appear to be used
+    ("Flags2", "<u4"), # unused?
+    ("Normal", "<f4", 3), # Normal Vector
+    ("Vector W", "<f4"), # Vector W?
+    ("Material", "<u4"), # Material
+    # Sometimes a zero-based index into the bitmap16.flx/bitmapC.flx/bitmapsh.flx file (whichever is the active option) 
+    # for the texture to use. In other cases this has a pattern but no strict correlation to the material. 
+    # Use the material list instead to select textures.
+    ("color", "u1", 4), # Color of the face in RGBA order, each element being between 0 (black/transparent) and 255 (bright/opaque).
+    ("Collision", "u1", 8), # Collision Related, for collision system (index list [so only values from 0, 1, or 2] 
+    # that contains the index of the vertex that is closest to each of the faces [order is: left,right,front,back,bottom,top]
+])
+
+vertexDtype = numpy.dtype([("position", "<f4", 3)])
+
+materialDtype = numpy.dtype([
+    ("Texture ID", "<u2"), # Zero-based index of the texture to use from the 
+    # bitmap16.flx/bitmapC.flx/bitmapsh.flx file (whichever is the active option).
+    ("Flags", "<u2"),
+    ("Subtexture Count", "<u2"),
+    ("Flags2", "<u2"),
+    ("First Face ID", "<u2"), # Zero-based index of the first face with this material.
+    ("Face Count", "<u2"), # The number of faces with this material.
+    ("Default Alpha", "u1"),
+    ("Modified Alpha", "u1"),
+    ("Animation Start", "u1"), # Starting Frame for animation
+    ("Animation End", "u1"), # Ending Frame for animation
+    ("CurFrame", "u1"),
+    ("Animation Speed", "u1"), # Animation Speed Speed of animation in frames per second
+    ("Animation type", "u1"),
+    ("Playback direction", "u1"), # 0 - forward, 1 - backward
+    ("Animation Timer related", "<u4"), # Animation timer value
+])
+
+def readSubmeshBlocks(buffer, offset):
+    # The header and the face, vertex and material blocks of the submesh starting at offset in buffer,
+    # each a single frombuffer view of it (nothing is copied or decoded yet). None if there is no submesh at this LOD level.
+    header = readSubmeshHeader(buffer, offset)
+    if header["Mesh Size"] == 0:
+        return None
+    rawFaces = numpy.frombuffer(buffer, dtype = faceDtype, count = header["Face Count"], offset = offset + header["Face Offset"] + 4)
+    vertices = numpy.frombuffer(buffer, dtype = vertexDtype, count = header["Vertex Count"], offset = offset + header["Vertex Offset"] + 4)
+    materials = numpy.frombuffer(buffer, dtype = materialDtype, count = header["Material Count"], offset = offset + header["Material Offset"] + 4)
+    return header, rawFaces, vertices, materials
+
+def readSubmeshData(buffer, offset):
+    # Parses the submesh (one LOD of one limb) starting at offset in buffer, usually a model record.
+    # The per-loop data comes out in blender's winding order, the points of each face being stored as (0, 2, 1).
+    # Returns None if there is no submesh at this LOD level.
+    blocks = readSubmeshBlocks(buffer, offset)
+    if blocks is None:
+        return None
+    header, rawFaces, vertices, materials = blocks
+
+    points = rawFaces["Points"][:, (0, 2, 1)]
+    normals = points["normal"].reshape(-1, 3)
+    lengths = numpy.linalg.norm(normals, axis = 1)
+    lengths[lengths == 0] = 1 # null normals stay null
+    submesh = dict()
+    submesh["header"] = header
+    submesh["vertices"] = vertices["position"].copy()
+    submesh["faces"] = points["index"].astype(numpy.int32)
+    submesh["UVs"] = points["texCoord"].reshape(-1, 2)
+    submesh["colors"] = numpy.repeat(rawFaces["color"] / numpy.float32(255), 3, axis = 0)
+    submesh["normals"] = normals / lengths[:, None]
+    submesh["materials"] = materials.copy()
+    submesh["materialIDs"] = numpy.zeros(header["Face Count"], dtype = numpy.int32)
+    for ID, material in enumerate(materials):
+        # assign material to faces
+        submesh["materialIDs"][material["First Face ID"]:material["First Face ID"] + material["Face Count"]] = ID
+    return submesh
+
+###decoded models
+
+def readModel(record, only_LOD_0 = False):
+    # Model header and bones of a sappear.flx record, each bone with its decoded submeshes added as "submeshes",
+    # in LOD order (None where a LOD level has no submesh). With only_LOD_0, only the first level is decoded.
+    header, bones = readModelHierarchy(record)
+    for bone in bones:
+        lods = bone["lods"][:1] if only_LOD_0 else bone["lods"]
+        bone["submeshes"] = [readSubmeshData(record, offset) for offset in lods]
+    return header, bones
+
+modelLODThresholds = ("LOD Threshold 0", "LOD Threshold 1", "LOD Threshold 2", "LOD Threshold 3")
+
+def selectLODs(thresholds, lodCounts, distances):
+    # LOD level for each of n objects seen from distances (game units), from the (n, 4) LOD thresholds and the LOD count
+    # of their model. The thresholds are read as the distances from which each next level takes over.
+    thresholds = numpy.asarray(thresholds, dtype = numpy.float64).reshape(-1, len(modelLODThresholds))
+    lodCounts = numpy.asarray(lodCounts)
+    farther = numpy.asarray(distances, dtype = numpy.float64)[:, None] > thresholds
+    farther &= numpy.arange(len(modelLODThresholds)) < (lodCounts - 1)[:, None] # only levels the model has
+    return farther.sum(axis = 1)
+
+def readModels(archive, modelIDs, only_LOD_0 = False):
+    # Decodes the given models of an archive. Returns the models by ID, None for those that failed,
+    # and the error message of each failure.
+    models = dict()
+    failures = dict()
+    for modelID in modelIDs:
+        try:
+            models[modelID] = readModel(archive.record(modelID), only_LOD_0)
+        except Exception as error:
+            models[modelID] = None
+            failures[modelID] = "{0}: {1}".format(type(error).__name__, error)
+    return models, failures
+
+def readModelBatch(filePath, modelIDs, only_LOD_0):
+    # worker side of decodeModels, each worker process maps the archive once
+    return readModels(openArchive(filePath), modelIDs, only_LOD_0)
+
+parallelModelThreshold = 32 # below this many models, starting worker processes costs more than it saves
+
+def decodeModels(filePath, modelIDs, only_LOD_0 = False, workers = None):
+    # Decodes each distinct model of modelIDs from the archive at filePath into plain arrays, like readModels,
+    # spread over a pool of worker processes (one per core by default). Models are handed out in ID order,
+    # in interleaved batches so that each worker gets a mix of small and large ones.
+    # Falls back to decoding in this process when there are few models or the pool can't be used.
+    modelIDs = sorted(set(modelIDs))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(modelIDs) // 2)
+    if workers <= 1 or len(modelIDs) < parallelModelThreshold:
+        return readModels(openArchive(filePath), modelIDs, only_LOD_0)
+    batchCount = workers * 4
+    batches = [modelIDs[i::batchCount] for i in range(batchCount)]
+    models = dict()
+    failures = dict()
+    try:
+        # spawn rather than fork, forking a process with running threads (like Blender) isn't safe
+        with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("spawn")) as executor:
+            for batchModels, batchFailures in executor.map(readModelBatch, itertools.repeat(filePath), batches, itertools.repeat(only_LOD_0)):
+                models.update(batchModels)
+                failures.update(batchFailures)
+    except Exception as error:
+        print("parallel model decoding failed ({0}), decoding in this process instead".format(error))
+        return readModels(openArchive(filePath), modelIDs, only_LOD_0)
+    return models, failures
+
+###merged static geometry
+
+def quaternionMatrices(quaternions):
+    # (..., 4) quaternions as (x, y, z, w), normalized first, to (..., 3, 3) rotation matrices
+    q = numpy.asarray(quaternions, dtype = numpy.float64)
+    q = q / numpy.linalg.norm(q, axis = -1, keepdims = True)
+    x, y, z, w = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    return numpy.stack((
+        numpy.stack((1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)), axis = -1),
+        numpy.stack((2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)), axis = -1),
+        numpy.stack((2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)), axis = -1),
+    ), axis = -2)
+
+def boneTransforms(bones):
+    # 4x4 transform of each bone (by limb ID) to the model's space, in game units, parents coming before their children.
+    # The root's own location and rotation are left out, like when a model is placed on the map (only its scale stays).
+    transforms = dict()
+    for i, bone in enumerate(bones):
+        matrix = numpy.identity(4)
+        if i > 0:
+            matrix[:3, :3] = quaternionMatrices((bone["Orientation X"], bone["Orientation Y"], bone["Orientation Z"], bone["Orientation W"]))
+            matrix[:3, 3] = bone["Position"]
+        matrix[:3, :3] *= (bone["Scale X"], bone["Scale Y"], bone["Scale Z"])
+        parent = transforms.get(bone["Parent ID"]) if bone["Parent ID"] != bone["Limb ID"] else None
+        if parent is not None:
+            matrix = parent @ matrix
+        transforms[bone["Limb ID"]] = matrix
+    return transforms
+
+# The material of a merged face is identified across models by its key, texture << 8 | frame,
+# the invisible material (texture 65535) having a single key whatever the frame.
+noTexture = 65535 # texture ID of invisible materials
+invisibleMaterialKey = noTexture << 8
+
+def modelGeometry(model, lod = 0):
+    # The submeshes of one LOD level of a model decoded by readModel, moved to the model's space (boneTransforms)
+    # and merged into one set of mesh arrays like readSubmeshData's, with the material key of each face instead of
+    # a material index. None if the level is empty.
+    header, bones = model
+    transforms = boneTransforms(bones)
+    parts = []
+    vertexCount = 0
+    for bone in bones:
+        submesh = bone["submeshes"][lod] if lod < len(bone["submeshes"]) else None
+        if submesh is None or len(submesh["faces"]) == 0:
+            continue
+        matrix = transforms[bone["Limb ID"]]
+        linear = matrix[:3, :3]
+        vertices = submesh["vertices"] @ linear.T + matrix[:3, 3]
+        normals = submesh["normals"] @ numpy.linalg.inv(linear) # inverse transpose, applied to rows
+        lengths = numpy.linalg.norm(normals, axis = 1)
+        lengths[lengths == 0] = 1
+        normals = normals / lengths[:, None]
+        faces = submesh["faces"]
+        UVs, colors = submesh["UVs"], submesh["colors"]
+        if numpy.linalg.det(linear) < 0:
+            # mirrored: reverse the winding, and the per-loop data with it
+            faces = faces[:, ::-1]
+            UVs, colors, normals = (loops.reshape(-1, 3, loops.shape[1])[:, ::-1].reshape(-1, loops.shape[1]) for loops in (UVs, colors, normals))
+        materials = submesh["materials"]
+        keys = (materials["Texture ID"].astype(numpy.int64) << 8) | numpy.where(materials["Texture ID"] == noTexture, 0, materials["CurFrame"])
+        parts.append((vertices, faces + vertexCount, UVs, colors, normals, keys[submesh["materialIDs"]] if len(keys) > 0 else
+            numpy.full(len(faces), invisibleMaterialKey, dtype = numpy.int64)))
+        vertexCount += len(vertices)
+    if len(parts) == 0:
+        return None
+    geometry = dict()
+    for i, name in enumerate(("vertices", "faces", "UVs", "colors", "normals", "materialKeys")):
+        geometry[name] = numpy.concatenate([part[i] for part in parts])
+    return geometry
+
+def mergeStaticInstances(geometries, modelIDs, positions, orientations, unitScale = 1.0):
+    # Bakes instances of models into one set of mesh arrays: geometries are modelGeometry results by model ID,
+    # and each instance is modelIDs[i] scaled by unitScale, rotated by orientations[i] ((x, y, z, w) quaternions)
+    # and moved to positions[i]. Instances are transformed in bulk, model by model.
+    # Returns the arrays with one material slot per face, numbered by first use, and the material key of each slot.
+    # None if none of the instances has geometry.
+    modelIDs = numpy.asarray(modelIDs)
+    positions = numpy.asarray(positions, dtype = numpy.float64)
+    rotations = quaternionMatrices(orientations)
+    parts = []
+    vertexCount = 0
+    for modelID in dict.fromkeys(modelIDs.tolist()):
+        geometry = geometries.get(modelID)
+        if geometry is None:
+            continue
+        instances = numpy.nonzero(modelIDs == modelID)[0]
+        count = len(instances)
+        vertices = numpy.einsum("kij,nj->kni", rotations[instances], geometry["vertices"] * unitScale) + positions[instances, None, :]
+        normals = numpy.einsum("kij,nj->kni", rotations[instances], geometry["normals"])
+        offsets = vertexCount + len(geometry["vertices"]) * numpy.arange(count)
+        faces = geometry["faces"][None, :, :] + offsets[:, None, None]
+        parts.append((vertices.reshape(-1, 3), faces.reshape(-1, 3), numpy.tile(geometry["UVs"], (count, 1)),
+            numpy.tile(geometry["colors"], (count, 1)), normals.reshape(-1, 3), numpy.tile(geometry["materialKeys"], count)))
+        vertexCount += len(geometry["vertices"]) * count
+    if len(parts) == 0:
+        return None
+    merged = dict()
+    for i, name in enumerate(("vertices", "faces", "UVs", "colors", "normals", "materialKeys")):
+        merged[name] = numpy.concatenate([part[i] for part in parts])
+    uniqueKeys, firstUse, inverse = numpy.unique(merged.pop("materialKeys"), return_index = True, return_inverse = True)
+    order = numpy.argsort(firstUse)
+    slots = numpy.empty(len(order), dtype = numpy.int32)
+    slots[order] = numpy.arange(len(order), dtype = numpy.int32)
+    merged["materialIDs"] = slots[inverse.ravel()]
+    merged["slotKeys"] = [int(key) for key in uniqueKeys[order]]
+    return merged
+
+###model catalog
+
+# A sidecar catalog of sappear.flx, built once per archive version from the model and submesh headers only,
+# so that importers know which models are valid, what they hold and which textures they use without decoding them.
+modelCatalogVersion = 1
+
+def catalogModel(record):
+    # Catalog entry of a model record: whether it is valid (and why not), its counts, bounds and LOD thresholds,
+    # and for each LOD level its triangle and vertex counts and the (texture, frame) pairs of its materials.
+    # A model is valid when every block of every submesh lies within the record and faces only use existing vertices.
+    entry = dict()
+    entry["valid"] = False
+    if len(record) == 0:
+        entry["error"] = "empty record"
+        return entry
+    try:
+        header, bones = readModelHierarchy(record)
+        lodCount = header["LOD Count"]
+        faceCounts = [0] * lodCount
+        vertexCounts = [0] * lodCount
+        textures = [dict() for lod in range(lodCount)] # used as ordered sets
+        for bone in bones:
+            for lod, offset in enumerate(bone["lods"]):
+                blocks = readSubmeshBlocks(record, offset)
+                if blocks is None:
+                    continue
+                submesh, rawFaces, vertices, materials = blocks
+                if len(rawFaces) > 0 and rawFaces["Points"]["index"].max() >= len(vertices):
+                    raise ValueError("submesh of limb {0} at LOD {1} uses missing vertices".format(bone["Limb ID"], lod))
+                if numpy.any(materials["First Face ID"].astype(numpy.int64) + materials["Face Count"] > len(rawFaces)):
+                    raise ValueError("submesh of limb {0} at LOD {1} has materials past its faces".format(bone["Limb ID"], lod))
+                faceCounts[lod] += len(rawFaces)
+                vertexCounts[lod] += len(vertices)
+                for material in materials:
+                    if material["Texture ID"] != noTexture:
+                        textures[lod][(int(material["Texture ID"]), int(material["CurFrame"]))] = None
+    except Exception as error:
+        entry["error"] = "{0}: {1}".format(type(error).__name__, error)
+        return entry
+    entry["valid"] = True
+    entry["submeshCount"] = header["Submesh Count"]
+    entry["lodCount"] = lodCount
+    entry["minimumBounds"] = header["Minimum Bounds"]
+    entry["maximumBounds"] = header["Maximum bounds"]
+    entry["sphereCenter"] = header["Sphere Center"]
+    entry["sphereRadius"] = header["Sphere Radius"]
+    entry["lodThresholds"] = [header["LOD Threshold {0}".format(i)] for i in range(4)]
+    entry["faceCounts"] = faceCounts
+    entry["vertexCounts"] = vertexCounts
+    entry["textures"] = [list(lodTextures) for lodTextures in textures]
+    return entry
+
+def buildModelCatalog(archive):
+    return [catalogModel(archive.record(modelID)) for modelID in range(len(archive))]
+
+loadedCatalogs = dict() # archive fingerprint: catalog
+
+def loadModelCatalog(directory, archive):
+    # The catalog of archive, from directory/<archive name>-<path hash>-<fingerprint>.catalog.json, built and written there
+    # first if there is none for this version of the archive. Catalogs of other versions of the archive at the same path
+    # are removed then, those of other archives of the same name (another install) are kept.
+    # Entries are indexed by model ID, and their pairs and vectors come back as lists.
+    catalog = loadedCatalogs.get(archive.fingerprint)
+    if catalog is not None:
+        return catalog
+    archiveName = os.path.basename(archive.filePath)
+    pathHash = hashlib.blake2b(os.path.abspath(archive.filePath).encode(), digest_size = 4).hexdigest()
+    prefix = "{0}-{1}-".format(archiveName, pathHash)
+    path = os.path.join(directory, "{0}{1}.catalog.json".format(prefix, archive.fingerprint))
+    try:
+        with open(path, "r") as file_object:
+            contents = json.load(file_object)
+        if contents.get("version") == modelCatalogVersion:
+            catalog = contents["models"]
+    except (OSError, ValueError, KeyError):
+        pass # missing or unreadable, built again below
+    if catalog is None:
+        catalog = buildModelCatalog(archive)
+        for entry in os.scandir(directory):
+            if entry.name.startswith(prefix) and entry.name.endswith(".catalog.json") and entry.path != path:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        temporaryPath = path + ".tmp"
+        try:
+            with open(temporaryPath, "w") as file_object:
+                json.dump({"version": modelCatalogVersion, "archive": archiveName, "models": catalog}, file_object)
+            os.replace(temporaryPath, path)
+        except OSError:
+            pass # the catalog is still used for this session
+    loadedCatalogs[archive.fingerprint] = catalog
+    return catalog
+
+def isValidModel(catalog, modelID):
+    return 0 <= modelID < len(catalog) and catalog[modelID]["valid"]
+
+def catalogTextures(catalog, modelIDs, lodCount = 1):
+    # The distinct (texture, frame) pairs the first lodCount LOD levels (all of them with None) of the valid models
+    # of modelIDs use, in order.
+    frames = dict()
+    for modelID in modelIDs:
+        if isValidModel(catalog, modelID):
+            for lodTextures in catalog[modelID]["textures"][:lodCount]:
+                frames.update(dict.fromkeys(tuple(frame) for frame in lodTextures))
+    return list(frames)
+
+###terrain
+
+terrainHeaderFormat = struct.Struct("<II128sIIII") # Total size is 0x98 bytes.
+terrainChunkSize = 16 # chunks are 16x16 points
+
+def readTerrainHeader(buffer, offset = 0):
+    fields = terrainHeaderFormat.unpack_from(buffer, offset)
+    header = dict()
+    header["width"] = fields[0]  #width in points
+    header["height"] = fields[1] #height in points
+    header["name"] = fields[2][:fields[2].index(b'\0')].decode("cp1252") # zero-terminated string
+    header["waterLevel"] = fields[3]
+    header["waveAmplitude"] = fields[4]
+    header["flags"] = fields[5]
+    header["chunkCount"] = fields[6]
+    return header
+
+def readTerrain(buffer):
+    # Returns the header, the chunk template index of each chunk as a (chunkHeight, chunkWidth) array
+    # and the chunk templates as a (chunkCount, 16, 16) array of packed point words, indexed [template, y, x].
+    header = readTerrainHeader(buffer)
+    chunkWidth = header["width"] // terrainChunkSize # Width of the terrain in chunks.
+    chunkHeight = header["height"] // terrainChunkSize # Height of the terrain in chunks.
+    offset = terrainHeaderFormat.size
+    indices = numpy.frombuffer(buffer, dtype = "<u2", count = chunkWidth * chunkHeight, offset = offset)
+    offset += indices.nbytes
+    chunkTemplates = numpy.frombuffer(buffer, dtype = "<u4", count = header["chunkCount"] * terrainChunkSize * terrainChunkSize, offset = offset)
+    return header, indices.reshape(chunkHeight, chunkWidth), chunkTemplates.reshape(-1, terrainChunkSize, terrainChunkSize)
+
+def terrainPointFields(words):
+    # Splits packed point words (any shape) into their bit fields.
+    fields = dict()
+    fields["height"] = words & 0xFFF # (bits 0-11) Height of the point, from 0 to 4095.
+    fields["isHole"] = words & 0x1000 !=0 # (bit 12) If true, then this is a hole in the scenery, such as for a cave or a building.
+    fields["swapUV"] = words & 0x2000 !=0 # (bit 13) Swap the X and Y axes for the texture coordinates
+    fields["mirrorUV"] = words & 0x4000 !=0 # (bit 14) Mirror the X and Y axes for the texture coordinates.
+    fields["flipDiagonal"] = words & 0x8000 !=0 # (bit 15) diagonal maybe?
+    fields["frame"] = (words >>16) & 0x3F # (bits 16-21) Frame index in the texture.
+    fields["texture"] = (words >>22) & 0x3FF # (bits 22-31) Texture index.
+    return fields
+
+terrainPointSpacing = 128 # game units from one point to the next
+terrainChunkExtent = terrainChunkSize * terrainPointSpacing # game units covered by a chunk
+
+def terrainPointGrid(indices, chunkTemplates, chunkX = 0, chunkY = 0, chunkColumns = None, chunkRows = None):
+    # Assembles the packed words of a block of chunks (the whole map by default) as an array indexed [y, x].
+    # It has one more row and column of points than the block, taken from the next chunks (wrapping around the map),
+    # so that it holds the corners of every tile of the block.
+    chunkHeight, chunkWidth = indices.shape
+    if chunkColumns is None:
+        chunkColumns = chunkWidth - chunkX
+    if chunkRows is None:
+        chunkRows = chunkHeight - chunkY
+    rows = numpy.arange(chunkY, chunkY + chunkRows + 1) % chunkHeight
+    columns = numpy.arange(chunkX, chunkX + chunkColumns + 1) % chunkWidth
+    # only the templates of these chunks are read
+    words = chunkTemplates[indices[rows][:, columns]].transpose(0, 2, 1, 3).reshape(
+        (chunkRows + 1) * terrainChunkSize, (chunkColumns + 1) * terrainChunkSize)
+    return words[:chunkRows * terrainChunkSize + 1, :chunkColumns * terrainChunkSize + 1]
+
+def terrainChunkBlock(indices, region):
+    # The block of chunks touching region, as (chunkX, chunkY, chunkColumns, chunkRows), and a mask of the chunks
+    # of the block that actually touch it (all but some corners for a disc), for buildTerrainGeometry.
+    # None if no chunk does.
+    chunkHeight, chunkWidth = indices.shape
+    y, x = numpy.mgrid[0:chunkHeight, 0:chunkWidth] * terrainChunkExtent
+    touching = regionIntersects(region, x, y, x + terrainChunkExtent, y + terrainChunkExtent)
+    rows, columns = numpy.nonzero(touching)
+    if len(rows) == 0:
+        return None
+    chunkX, chunkY = columns.min(), rows.min()
+    chunkColumns, chunkRows = columns.max() + 1 - chunkX, rows.max() + 1 - chunkY
+    chunkMask = touching[chunkY:chunkY + chunkRows, chunkX:chunkX + chunkColumns]
+    return (int(chunkX), int(chunkY), int(chunkColumns), int(chunkRows)), chunkMask
+
+# Each tile is a quad with corners v1 (x, y), v2 (x+1, y), v3 (x, y+1), v4 (x+1, y+1), numbered 0 to 3 here.
+# Corners of the two triangles of a tile, indexed by flipDiagonal.
+terrainTileTriangles = numpy.array((
+    ((0, 1, 3), (0, 3, 2)),
+    ((0, 1, 2), (1, 3, 2)),
+))
+# UV of each corner, indexed by rotation (swapUV + 2 * mirrorUV). swap and mirror are actually quarter turns.
+terrainCornerUVs = numpy.array((
+    ((0, 1), (1, 1), (0, 0), (1, 0)),
+    ((1, 1), (1, 0), (0, 1), (0, 0)), #swapuv, actually quarter turn
+    ((1, 0), (0, 0), (1, 1), (0, 1)), #one half turn
+    ((0, 0), (0, 1), (1, 0), (1, 1)), #three quarter turn
+), dtype = numpy.float32)
+
+def terrainTileBlocks(chunkBlock, tileSize):
+    # Splits a block of chunks (chunkX, chunkY, chunkColumns, chunkRows) into tiles of tileSize x tileSize chunks,
+    # aligned on the map so that a tile always covers the same chunks whatever the block.
+    # Returns (tileX, tileY, tile block) for each tile touching the block, with the tile blocks clipped to it.
+    chunkX, chunkY, chunkColumns, chunkRows = chunkBlock
+    tiles = []
+    for tileY in range(chunkY // tileSize, (chunkY + chunkRows - 1) // tileSize + 1):
+        for tileX in range(chunkX // tileSize, (chunkX + chunkColumns - 1) // tileSize + 1):
+            firstX, firstY = max(tileX * tileSize, chunkX), max(tileY * tileSize, chunkY)
+            lastX = min((tileX + 1) * tileSize, chunkX + chunkColumns)
+            lastY = min((tileY + 1) * tileSize, chunkY + chunkRows)
+            tiles.append((tileX, tileY, (firstX, firstY, lastX - firstX, lastY - firstY)))
+    return tiles
+
+def terrainTemplateTiles(chunkTemplates, templates, step = 1):
+    # The tiles of the given chunk templates that aren't holes, with what a tile takes from its first corner,
+    # computed once per template rather than once per chunk using it. A tile covers step x step points.
+    # Returns the first (start) and number (count) of tiles of each template, and for each tile, template by template,
+    # its position in the chunk, the corners of its two triangles, the UVs of their loops and its texture key.
+    fields = terrainPointFields(chunkTemplates[templates][:, ::step, ::step])
+    template, tileY, tileX = numpy.nonzero(~fields["isHole"])
+    count = numpy.bincount(template, minlength = len(templates))
+    start = numpy.concatenate(((0,), numpy.cumsum(count)[:-1]))
+    triangleCorners = terrainTileTriangles[fields["flipDiagonal"][template, tileY, tileX].astype(numpy.intp)].reshape(-1, 6)
+    rotation = fields["swapUV"][template, tileY, tileX].astype(numpy.intp) + 2 * fields["mirrorUV"][template, tileY, tileX]
+    UVs = terrainCornerUVs[rotation[:, None], triangleCorners] # (tiles, 6, 2)
+    keys = (fields["texture"][template, tileY, tileX] << 6) | fields["frame"][template, tileY, tileX]
+    return start, count, tileX, tileY, triangleCorners, UVs, keys
+
+def buildTerrainGeometry(indices, chunkTemplates, chunkBlock, squareLength, heightUnit, step = 1, chunkMask = None):
+    # Turns a block of chunks (chunkX, chunkY, chunkColumns, chunkRows) into mesh arrays: one vertex per point,
+    # from (0, 0) on, two triangles per tile that isn't a hole, one UV per loop and one material slot per triangle.
+    # step keeps every step-th point in both directions (it must divide the chunk size), each remaining tile
+    # taking the flags and texture of its first corner.
+    # The tiles are worked out once per template the block uses (terrainTemplateTiles) then stamped into every chunk
+    # using it, chunk by chunk, so only the vertex heights are read point by point.
+    # chunkMask optionally leaves out chunks of the block, and then the vertices no triangle uses are dropped.
+    # textureFrames lists the (texture, frame) pair of each material slot, in order of first use.
+    if terrainChunkSize % step != 0:
+        raise ValueError("terrain step must divide {0}, not {1}".format(terrainChunkSize, step))
+    chunkX, chunkY, chunkColumns, chunkRows = chunkBlock
+    chunkTiles = terrainChunkSize // step
+    height, width = chunkRows * chunkTiles, chunkColumns * chunkTiles
+
+    heights = terrainPointGrid(indices, chunkTemplates, *chunkBlock)[::step, ::step] & 0xFFF
+    y, x = numpy.mgrid[0:height + 1, 0:width + 1]
+    vertices = numpy.empty(((height + 1) * (width + 1), 3), dtype = numpy.float32)
+    vertices[:, 0] = (squareLength * step * x).ravel()
+    vertices[:, 1] = (squareLength * step * y).ravel()
+    vertices[:, 2] = (heights * heightUnit).ravel()
+
+    chunkIndices = indices[chunkY:chunkY + chunkRows, chunkX:chunkX + chunkColumns]
+    rows, columns = numpy.nonzero(chunkMask if chunkMask is not None else numpy.ones(chunkIndices.shape, dtype = bool))
+    templates, chunkSlots = numpy.unique(chunkIndices[rows, columns], return_inverse = True)
+    start, count, tileX, tileY, triangleCorners, UVs, keys = terrainTemplateTiles(chunkTemplates, templates, step)
+
+    # stamp: tile i of the output is tile tiles[i] of the template of chunk chunkOfTile[i]
+    chunkCounts = count[chunkSlots]
+    chunkOfTile = numpy.repeat(numpy.arange(len(chunkSlots)), chunkCounts)
+    tiles = numpy.arange(chunkCounts.sum()) + numpy.repeat(start[chunkSlots] - (numpy.cumsum(chunkCounts) - chunkCounts), chunkCounts)
+    stride = width + 1
+    v1 = (rows[chunkOfTile] * chunkTiles + tileY[tiles]) * stride + columns[chunkOfTile] * chunkTiles + tileX[tiles]
+    corners = numpy.stack((v1, v1 + 1, v1 + stride, v1 + stride + 1), axis = 1)
+    faces = numpy.take_along_axis(corners, triangleCorners[tiles], axis = 1).reshape(-1, 3)
+    if chunkMask is not None:
+        usedVertices, faces = numpy.unique(faces, return_inverse = True)
+        faces = faces.reshape(-1, 3)
+        vertices = vertices[usedVertices]
+    UVs = UVs[tiles].reshape(-1, 2)
+
+    # material slots, numbered by first use, worked out on the template tiles too:
+    # a template tile is first used in the first chunk of its template
+    uniqueKeys, inverse = numpy.unique(keys, return_inverse = True)
+    templateSlots, firstChunk = numpy.unique(chunkSlots, return_index = True)
+    firstTile = numpy.zeros(len(templates), dtype = numpy.int64)
+    firstTile[templateSlots] = (numpy.cumsum(chunkCounts) - chunkCounts)[firstChunk]
+    tileTemplates = numpy.repeat(numpy.arange(len(templates)), count)
+    firstUse = numpy.full(len(uniqueKeys), numpy.iinfo(numpy.int64).max)
+    numpy.minimum.at(firstUse, inverse, firstTile[tileTemplates] + numpy.arange(len(keys)) - start[tileTemplates])
+    order = numpy.argsort(firstUse)
+    slots = numpy.empty(len(order), dtype = numpy.int32)
+    slots[order] = numpy.arange(len(order), dtype = numpy.int32)
+    materialIDs = numpy.repeat(slots[inverse][tiles], 2)
+    textureFrames = [(int(key >> 6), int(key & 0x3F)) for key in uniqueKeys[order]]
+    return vertices, faces, UVs, materialIDs, textureFrames
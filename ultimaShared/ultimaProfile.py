@@ -0,0 +1,103 @@
+# Phase timing for the importers. An import makes its profile active, and the code it runs reports its phases to it
+# through the module level helpers, which do nothing when no profile is active.
+# Phases are timed inclusively: a phase running inside another one counts in both.
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+class ImportProfile:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.startCounter = time.perf_counter()
+        self.seconds = None
+        self.phases = dict() # name: dict of seconds, calls, bytes
+        self.counters = dict() # name: value
+        self.datablocks = dict() # kind: number created
+        self.notes = dict() # anything else worth keeping in the report
+
+    def phaseEntry(self, name):
+        entry = self.phases.get(name)
+        if entry is None:
+            entry = {"seconds": 0.0, "calls": 0, "bytes": 0}
+            self.phases[name] = entry
+        return entry
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.startCounter
+
+    def report(self):
+        report = dict()
+        report["name"] = self.name
+        report["started"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started))
+        report["seconds"] = self.seconds if self.seconds is not None else time.perf_counter() - self.startCounter
+        report["phases"] = dict(sorted(self.phases.items(), key = lambda item: -item[1]["seconds"]))
+        report["counters"] = self.counters
+        report["datablocks"] = self.datablocks
+        report.update(self.notes)
+        return report
+
+    def write(self, directory):
+        os.makedirs(directory, exist_ok = True)
+        path = os.path.join(directory, "{0}-{1}.json".format(self.name, time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))))
+        with open(path, "w") as file_object:
+            json.dump(self.report(), file_object, indent = 2)
+        return path
+
+    def printSummary(self):
+        report = self.report()
+        print("{0}: {1:.3f} seconds".format(self.name, report["seconds"]))
+        for name, entry in report["phases"].items():
+            print("    {0:<24} {1:>9.3f} s {2:>8} calls {3:>12} bytes".format(name, entry["seconds"], entry["calls"], entry["bytes"]))
+        for kind, created in self.datablocks.items():
+            print("    {0:<24} {1:>9} created".format(kind, created))
+
+current = None # the profile phases are reported to, only set through active
+
+@contextmanager
+def active(profile):
+    # makes profile the current one for a while, for imports that run in several steps (see ultimaBlender.ProfiledRun)
+    global current
+    previous = current
+    current = profile
+    try:
+        yield
+    finally:
+        current = previous
+
+@contextmanager
+def phase(name, bytesRead = 0):
+    profile = current
+    if profile is None:
+        yield
+        return
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = profile.phaseEntry(name)
+        entry["seconds"] += time.perf_counter() - begin
+        entry["calls"] += 1
+        entry["bytes"] += bytesRead
+
+def timedIteration(name, iterable):
+    # Times the wait for each item of iterable as the phase name, for work done ahead of the consumer (like a pool).
+    iterator = iter(iterable)
+    finished = object()
+    while True:
+        with phase(name):
+            item = next(iterator, finished)
+        if item is finished:
+            return
+        yield item
+
+def addBytes(name, amount):
+    # for phases whose size is only known once they're done
+    if current is not None:
+        current.phaseEntry(name)["bytes"] += amount
+
+def count(name, amount = 1):
+    if current is not None:
+        current.counters[name] = current.counters.get(name, 0) + amount
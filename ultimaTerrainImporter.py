@@ -20,187 +20,72 @@ import os # for path stuff
 import ntpath
 import math 
 
-from bpy.props import CollectionProperty #for multiple files
-from bpy.types import OperatorFileListElement
-
-try: 
-    import struct
-except: 
-    struct = None
-
-###
-# https://docs.python.org/3/library/struct.html
-# < little endian, i integer. B would be unsigned char (ie ubyte in c#), ? would be C99 1-byte bool
-
-def readInt32(file_object):
-    return struct.unpack("<i", file_object.read(4))[0] 
-
-def readUInt32(file_object):
-    return struct.unpack("<I", file_object.read(4))[0]
-
-def readUByte(file_object):
-    return struct.unpack("<B", file_object.read(1))[0]
-
-def readFloat(file_object):
-    return struct.unpack("<f", file_object.read(4))[0]
-    
-def readUInt16(file_object):
-    return struct.unpack("<H", file_object.read(2))[0]
+import numpy # bundled with Blender
 
-def readBool(file_object):
-    return struct.unpack("<?", file_object.read(1))[0]
+if "ultimaFormats" in globals(): # Blender is reloading the add-on (Reload Scripts), the shared modules follow it
+    import importlib
+    for module in (ultimaFormats, ultimaProfile, ultimaBlender): # ultimaBlender uses the other two
+        importlib.reload(module)
+from ultimaShared import ultimaFormats # shared format readers, in the ultimaShared folder next to this file
+from ultimaShared import ultimaBlender # shared blender helpers, same
+from ultimaShared import ultimaProfile # import phase timing, same
 
-def readUInt64(file_object):
-    return struct.unpack("<Q", file_object.read(8))[0]
-
-def readUBytes(file_object, count):
-    xs = bytearray()
-    for i in range(count):
-        xs.append(readUByte(file_object))
-    return xs
-
-#complex types
-
-def readColor32(file_object):
-    B= readUByte(file_object)/255
-    G= readUByte(file_object)/255
-    R= readUByte(file_object)/255
-    A= readUByte(file_object)/255
-    return [R,G,B,A]
-
-def readColor16_5551(file_object):
-    rawColor = readUInt16(file_object);
-    b = ((rawColor) & 0b11111) / 31 # Shift 0, mask 31.
-    g = ((rawColor >> 5) & 0b11111) / 31 # Shift 5, mask 0x3E0.
-    r = ((rawColor >> 10) & 0b11111) / 31 # Shift 10, mask 0x7C00.
-
-    a = (rawColor >> 15) & 1 # Shift 15, mask 0x8000.
-    return [r,g,b,a]
-
-def readColor16_565(file_object):
-    rawColor = readUInt16(file_object);
-    b = ((rawColor) & 0b11111) / 31 # Shift 0, mask 31.
-    g = ((rawColor >> 5) & 0b111111) / 63 # Shift 5, mask 0x3E0.
-    r = ((rawColor >> 11) & 0b11111) / 31 # Shift 10, mask 0x7C00.
-
-    a = 1.0
-    return [r,g,b,a]
-
-###FLX archive
+from bpy.props import CollectionProperty #for multiple files
+from bpy.types import OperatorFileListElement
 
-def readArchiveHeader(file_object):
-    header = dict()
-    
-    header["unused1"] = readUBytes(file_object, 0x4C)  # = 0x20
-    header["unused2"] = readUInt32(file_object)  # = 0x00
-    header["count"] = readUInt32(file_object)  # The number of records.
-    header["unused3"] = readUInt32(file_object)  # Perhaps it's a version number.
-    header["size"] = readUInt32(file_object)  # Size in bytes of the archive file.
-    header["size2"] = readUInt32(file_object)  # Also the size in bytes of the archive file.
-    header["unused4"] = readUInt32(file_object)
-    header["unused4_2"] = readUInt32(file_object)
-    header["unused5"] = readUInt32(file_object)  # = 0x01
-    header["unused5_2"] = readUInt32(file_object)  # an extra to reach 0x80 length
-
-    header["unused6"] = readUBytes(file_object, 0x10)  # = 0x00
-    return header # Total size is 0x80 bytes.
-
-def readArchiveRecord(file_object):
-    record = dict()
-    record["offset"] = readUInt32(file_object)  # Byte offset from the beginning of the file to the record data.
-    record["size"] = readUInt32(file_object)  # Size in bytes of the record.
-    return record # Total size is 0x08 bytes.
-
-#bitmap records
-
-def readTextureSetHeader(file_object):
-    header=dict()
-    header["frameWidth"] = readUInt16(file_object)  # Maximum width in pixels of all the frames.
-    header["format"]= readUInt16(file_object) # enum TextureFormat
-    header["frameHeight"] = readUInt16(file_object)  # Maximum height in pixels of all the frames.
-    header["compression"] = readUInt16(file_object)  # Uncompressed = 0x00, Unknown = 0x01 (Used with some 8-bit textures)
-    header["count"] = readUInt32(file_object)  # The number of frames.; u9tools thinks count is 4 bytes, othes specs say 2
-    header["unknown"] = readUInt32(file_object)  #
-    return header # Total size is 0x10 bytes.
-
-def readFrameRecord(file_object):
-    record = dict()
-    record["offset"] = readUInt32(file_object) # Offset of the frame relative to the start of the resource.
-    record["length"] = readUInt32(file_object) # Size in bytes of the frame data.
-    return record
-
-def readFrameHeader(file_object):
-    header=dict()
-    header["unknown1"] = readUInt16(file_object)  #
-    header["unknown2"] = readUInt16(file_object)  #Usually 0x6000
-    header["width"] = readUInt32(file_object) # Width in pixels of the frame
-    header["height"] = readUInt32(file_object) # Height in pixels of the frame
-    header["unknown3"] = readUInt32(file_object) # Almost always 0
-    header["unknown4"] = readUInt32(file_object) # Almost always 0
-    header["offsets"] =[]
-    for i in range(header["height"]):
-        header["offsets"].append(readUInt32(file_object)) # Offset to the data for each row relative to the start of the resource
-    return header # Basic size is 0x14 bytes.
+###textures
 
 def chunkTextureName(textureIndex, frameIndex):
     return "bitmap16_{0}_{1}".format(textureIndex, frameIndex)
 
-def makeTexture(archiveRecords, textureIndex, frameIndex, textureFile_object):
-    textureFile_object.seek(archiveRecords[textureIndex]["offset"], 0)
-    textureSetHeader = readTextureSetHeader(textureFile_object)
-    frameRecords = []
-    for i in range(textureSetHeader["count"]):
-        frameRecords.append(readFrameRecord(textureFile_object))
-    #go to specific frame
-    textureFile_object.seek(archiveRecords[textureIndex]["offset"] + frameRecords[frameIndex]["offset"], 0)
-    frameHeader = readFrameHeader(textureFile_object)
-    imageData =[]
-    for i in range(frameHeader["width"]*frameHeader["height"]):
-        color=readColor16_565(textureFile_object)
-        imageData.extend(color)
+def makeTexture(textureIndex, frameIndex, frameHeader, imageData):
+    # frameHeader and imageData come decoded from ultimaFormats.loadTextureFrame
+    ultimaProfile.addBytes("decode textures", frameHeader["width"] * frameHeader["height"] * (1 if frameHeader["is8bit"] else 2))
         
-    image = bpy.data.images.new(chunkTextureName(textureIndex, frameIndex), 
-        frameHeader["width"], frameHeader["height"], alpha = True)
-    image.pixels = imageData
-    image.file_format = 'PNG'
-    image.pack()
+    with ultimaProfile.phase("create images"):
+        image = bpy.data.images.new(chunkTextureName(textureIndex, frameIndex), 
+            frameHeader["width"], frameHeader["height"], alpha = True)
+        image.pixels.foreach_set(imageData)
+        image.file_format = 'PNG'
+    with ultimaProfile.phase("pack images"):
+        image.pack()
 
     return image
 
+def linkTexture(externalImages, textureIndex, frameIndex, frameHeader, path, written):
+    # like makeTexture, for frames written to an external file by ultimaFormats.exportTextureFrame,
+    # externalImages being an ultimaBlender.ExternalImages
+    if written:
+        ultimaProfile.addBytes("decode textures", frameHeader["width"] * frameHeader["height"] * (1 if frameHeader["is8bit"] else 2))
+    return externalImages.load(chunkTextureName(textureIndex, frameIndex), path)
+
+def makeAtlasTexture(name, atlas, textureFiles = None, externalImages = None):
+    # atlas is a (height, width, 4) array from ultimaFormats.packTextureAtlases
+    if textureFiles is not None:
+        with ultimaProfile.phase("write image files"):
+            path = textureFiles.writeImage(name, atlas)
+        return externalImages.load(name, path)
+    with ultimaProfile.phase("create images"):
+        image = bpy.data.images.new(name, atlas.shape[1], atlas.shape[0], alpha = True)
+        image.pixels.foreach_set(atlas.ravel())
+        image.file_format = 'PNG'
+    with ultimaProfile.phase("pack images"):
+        image.pack()
+    return image
+
 ### terrain
 
-def readHeader(file_object):
-    header = dict()
-
-    header["width"] = readUInt32(file_object)  #width in points
-    header["height"] = readUInt32(file_object) #height in points
-    rawName = readUBytes(file_object, int(0x80))
-    header["name"] = rawName[:rawName.index(b'\0')].decode("cp1252") # zero-terminated string
-    header["waterLevel"] = readUInt32(file_object)
-    header["waveAmplitude"] = readUInt32(file_object)
-    header["flags"] = readUInt32(file_object)
-    header["chunkCount"] = readUInt32(file_object)
-    
-    return header
-
-def readPoint(file_object):
-    tile = dict()
-    rawTile = readUInt32(file_object)
-    tile["height"] = rawTile & 0xFFF # (bits 0-11) Height of the point, from 0 to 4095.
-    tile["isHole"] = rawTile & 0x1000 !=0 # (bit 12) If true, then this is a hole in the scenery, such as for a cave or a building.
-    tile["swapUV"] = rawTile & 0x2000 !=0 # (bit 13) Swap the X and Y axes for the texture coordinates
-    tile["mirrorUV"] = rawTile & 0x4000 !=0 # (bit 14) Mirror the X and Y axes for the texture coordinates.
-    tile["flipDiagonal"] = rawTile & 0x8000 !=0 # (bit 15) diagonal maybe?
-    tile["frame"] = (rawTile >>16) & 0x3F # (bits 16-21) Frame index in the texture.
-    tile["texture"] = (rawTile >>22) & 0x3FF # (bits 22-31) Texture index.
-    return tile
-
-ChunkSize = 16
+ChunkSize = ultimaFormats.terrainChunkSize
 squareLength = 3.2 # 8.0 * 0.4
 heightUnit = 0.1 # 0.25 * 0.4
 
-def makeMaterial(texture): #specifically for terrain, with "extend"
-    mat = bpy.data.materials.new(texture.name)
+def getTextureCache(textureArchive):
+    directory = bpy.utils.user_resource('DATAFILES', path = "ultima9_texture_cache", create = True)
+    return ultimaFormats.TextureCache(directory, textureArchive)
+
+def makeMaterial(name, texture = None): #specifically for terrain, with "extend"
+    # the texture can also be set later, see setMaterialTexture
+    mat = bpy.data.materials.new(name)
     mat.use_nodes = True
     mat.use_backface_culling = True
     nodes = mat.node_tree.nodes
@@ -212,178 +97,143 @@ def makeMaterial(texture): #specifically for terrain, with "extend"
     mat.node_tree.links.new(mainNode.inputs["Base Color"], textureNode.outputs["Color"])
     return mat
 
-def ImportModel(modelFilePath, textureFilePath):
-    file_object = open(modelFilePath, "rb")
-
-    header = readHeader(file_object)
-    print(header)
+def setMaterialTexture(material, texture):
+    material.node_tree.nodes["Image Texture"].image = texture
 
-    chunkWidth = header["width"] // ChunkSize # Width of the terrain in chunks.
-    chunkHeight = header["height"] // ChunkSize # Height of the terrain in chunks.
-    chunkCount = chunkWidth * chunkHeight # Number of chunks in the terrain.
-    print("chunkWidth : {0}, chunkHeight : {1}, chunkCount: {2}".format(chunkWidth, chunkHeight, chunkCount))
-
-    indices = [] # Chunk template index to use for each tile in [x + y * header.chunkWidth] order
-    for i in range(chunkCount):
-        indices.append(readUInt16(file_object)) 
-
-    chunkTemplates = []
-    for i in range(header["chunkCount"]):
-        points=[] #List of points in [x + y * ChunkSize] order.
-        for j in range(ChunkSize * ChunkSize):
-            points.append(readPoint(file_object))
-        chunkTemplates.append(points)
-
-    file_object.close()
-    vertices = []
-    heightMap = [0.0] * header["width"] * header["height"]
-    for i in range(chunkWidth):
-        for j in range(chunkHeight):
-            tile_offset_x = ChunkSize * i
-            tile_offset_y = ChunkSize * j
-            for x in range(ChunkSize):
-                for y in range(ChunkSize):
-                    heightMap[tile_offset_x+x +(tile_offset_y+y) * header["width"]] = chunkTemplates[
-                    indices[i + j* chunkWidth]][x+y*ChunkSize]["height"]* heightUnit
-
-    for y in range(header["height"]+1):
-        for x in range(header["width"]+1):
-            vertices.append((squareLength * x, 
-                            squareLength * y, 
-                            heightMap[x % header["width"] + (y % header["height"] ) * header["width"]]))
-    
-    textureFile_object = open(textureFilePath, "rb")
-    flxHeader = readArchiveHeader(textureFile_object)
-
-    archiveRecords = []
-    for i in range(flxHeader["count"]):
-        archiveRecords.append(readArchiveRecord(textureFile_object))
-
-
-    faces = []
-    textures = dict()
-    materialSlots = []
-    materialIDs = []
-    UVs = []
-
-    stride = header["width"] + 1
-    for y in range(header["height"]):
-        for x in range(header["width"]):
-            v1 = x + y * stride
-            v2 = x + 1 + y * stride
-            v3 = x + (y+1) * stride
-            v4 = x + 1 + (y+1) * stride
-
-            chunk_offset_x = x//ChunkSize
-            chunk_offset_y = y//ChunkSize
-            inside_coord_x = x%ChunkSize
-            inside_coord_y = y%ChunkSize
-            chunk = chunkTemplates[indices[chunk_offset_x+chunkWidth*chunk_offset_y]][inside_coord_x+ ChunkSize * inside_coord_y]
-
-            if chunk["isHole"] == False:
-                if chunk["flipDiagonal"] == True:
-                    faces.append((v1, v2, v3))
-                    faces.append((v2, v4, v3))
-                else:
-                    faces.append((v1, v2, v4))
-                    faces.append((v1, v4, v3))
-
-                textureIndex = chunk["texture"]
-                frameIndex = chunk["frame"]
-                key = chunkTextureName(textureIndex, frameIndex)
-                if key not in textures:
-                    image = makeTexture(archiveRecords, textureIndex, frameIndex, textureFile_object)
-                    textures[key]=len(materialSlots)
-                    materialSlots.append(makeMaterial(image))
-                    #create basic material, link texture to diffuse through image node with "extend"
-                    #also need to have generated UVs
-                materialIDs.append(textures[key]) #add the material slot number
-                materialIDs.append(textures[key])
-
-                #UV
-                
-                uv3 = (0, 0)
-                uv4 = (1, 0)
-                uv2 = (1, 1)
-                uv1 = (0, 1)
-                
-                # if chunk["swapUV"] == True:
-                #     uv3 = (0, 0)
-                #     uv4 = (0, 1)
-                #     uv2 = (1, 1)
-                #     uv1 = (1, 0)
-                # if chunk["mirrorUV"] == True: 
-                #     uv3 = (0, 1)
-                #     uv4 = (1, 1)
-                #     uv2 = (1, 0)
-                #     uv1 = (0, 0)
-                    
-                #     if chunk["swapUV"] == True:
-                #         uv3 = (1, 0)
-                #         uv4 = (1, 1)
-                #         uv2 = (0, 1)
-                #         uv1 = (0, 0)
-
-                #swap and mirror actually quarter turns?
-                rotate = 0
-                if chunk["swapUV"] == True:
-                    rotate +=1
-                if chunk["mirrorUV"] == True: 
-                    rotate +=2
-
-                if rotate == 3:
-                    uv1 = (0, 0)
-                    uv3 = (1, 0)
-                    uv4 = (1, 1) #three quarter turn
-                    uv2 = (0, 1)
-                if rotate == 2:
-                    uv2 = (0, 0)
-                    uv1 = (1, 0)
-                    uv3 = (1, 1) #one half turn
-                    uv4 = (0, 1)
-
-                if rotate == 1: #swapuv, actually quarter turn
-                    uv4 = (0, 0)
-                    uv2 = (1, 0)
-                    uv1 = (1, 1)
-                    uv3 = (0, 1)
-
-                if chunk["flipDiagonal"] == True: #diagonal test
-                    UVs.extend((uv1, uv2, uv3))
-                    UVs.extend((uv2, uv4, uv3))
-                else:
-                    UVs.extend((uv1, uv2, uv4))
-                    UVs.extend((uv1, uv4, uv3))
-    
-    #build the blender mesh
-    objectName = header["name"]
-    mesh = bpy.data.meshes.new(objectName)
-    mesh.from_pydata(vertices, [], faces) #(x y z) vertices, (1 2) edges, (variable index count) faces 
+def applyAtlas(mesh, UVs, materialIDs, materials):
+    # gives a terrain mesh built without UVs or materials its place in the texture atlases
+    mesh.uv_layers.new(name = 'DefaultUV').data.foreach_set("uv", numpy.asarray(UVs, dtype = numpy.float32).ravel())
+    mesh.polygons.foreach_set("material_index", numpy.asarray(materialIDs, dtype = numpy.int32))
+    for material in materials:
+        mesh.materials.append(material)
 
-    #add to scene
-    object = bpy.data.objects.new(objectName, mesh)
-    scene = bpy.context.scene
-    scene.collection.objects.link(object)
+def ImportModel(modelFilePath, textureFilePath, useTextureCache = True, useParallelDecoding = True, region = None,
+    tileSize = 0, step = 1, useAtlas = False, textureDetail = (0, 0), useExternalTextures = False):
+    # region (game units) limits the import to the chunks that touch it, the others aren't even read from the file.
+    # With a tileSize, the terrain is split into one object per tileSize x tileSize chunks, named after its place on the map.
+    # step keeps every step-th point only (1, 2, 4, 8 or 16).
+    # With useAtlas, all the texture frames go into one atlas (or a few for very large maps), each with a single material.
+    # textureDetail is the (mipLevel, maxSize) textures are decoded at, see ultimaFormats.loadTextureFrame.
+    # With useExternalTextures, images are linked to TGA files (see ultimaBlender.getTextureFiles) instead of being packed.
+    # A generator yielding (stage, done, total) after each piece and texture, to be run by ultimaBlender.ModalImport.
+    data = ultimaFormats.mapFile(modelFilePath)
+    with ultimaProfile.phase("parse terrain"):
+        header, indices, chunkTemplates = ultimaFormats.readTerrain(data)
+    print(header)
 
-    #mesh UVs
-    new_uv = mesh.uv_layers.new(name = 'DefaultUV')
-    
-    for loop in mesh.loops:
-        new_uv.data[loop.index].uv = UVs[loop.index]
+    chunkHeight, chunkWidth = indices.shape # Size of the terrain in chunks.
+    print("chunkWidth : {0}, chunkHeight : {1}, chunkCount: {2}".format(chunkWidth, chunkHeight, indices.size))
 
-    for faceIndex, face in enumerate(mesh.polygons):
-        face.material_index = materialIDs[faceIndex]
-    for material in materialSlots:
-        mesh.materials.append(material)
-    textureFile_object.close()
+    chunkBlock = (0, 0, chunkWidth, chunkHeight)
+    chunkMask = None
+    if region is not None:
+        found = ultimaFormats.terrainChunkBlock(indices, region)
+        if found is None:
+            print("the import region is outside of the terrain")
+            return
+        chunkBlock, chunkMask = found
+        print("importing chunks {0} to {1}".format(chunkBlock[:2], (chunkBlock[0] + chunkBlock[2] - 1, chunkBlock[1] + chunkBlock[3] - 1)))
 
-    #generate auto normals for terrain
-    mesh.use_auto_smooth = True
-    mesh.normals_split_custom_set_from_vertices([(0,0,0)] * len(vertices))
+    objectName = header["name"]
+    if tileSize > 0:
+        pieces = [("{0} tile {1}_{2}".format(objectName, tileX, tileY), block)
+            for tileX, tileY, block in ultimaFormats.terrainTileBlocks(chunkBlock, tileSize)]
+    else:
+        pieces = [(objectName, chunkBlock)]
+
+    # Each piece becomes an object as soon as it is built, so that stopping the import keeps the pieces made so far.
+    # Their materials get their texture once all the pieces are there, so that the textures are decoded together.
+    # Atlas UVs depend on every frame, pieces get them and their materials at the very end then.
+    collection = bpy.context.scene.collection
+    if len(pieces) > 1:
+        collection = bpy.data.collections.new(objectName)
+        bpy.context.scene.collection.children.link(collection)
+    textureFrames = dict() # (texture, frame): material (or atlas placement), in order of first use
+    atlasPieces = [] # mesh, UVs, material IDs and frames of each piece, for useAtlas
+    for i, (name, block) in enumerate(pieces):
+        yield "Building terrain", i, len(pieces)
+        chunkX, chunkY, chunkColumns, chunkRows = block
+        pieceMask = None
+        if chunkMask is not None:
+            firstX, firstY = chunkX - chunkBlock[0], chunkY - chunkBlock[1]
+            pieceMask = chunkMask[firstY:firstY + chunkRows, firstX:firstX + chunkColumns]
+        with ultimaProfile.phase("terrain geometry"):
+            vertices, faces, UVs, materialIDs, pieceFrames = ultimaFormats.buildTerrainGeometry(indices, chunkTemplates, block,
+                squareLength, heightUnit, step, pieceMask)
+        if len(faces) == 0:
+            continue # all holes or outside the region
+        ultimaProfile.count("terrain chunks", chunkColumns * chunkRows)
+        ultimaProfile.count("terrain faces", len(faces))
+
+        #build the blender mesh
+        # auto normals for terrain
+        if useAtlas == True:
+            mesh = ultimaBlender.buildMesh(name, vertices, faces)
+            atlasPieces.append((mesh, UVs, materialIDs, pieceFrames))
+            textureFrames.update(dict.fromkeys(pieceFrames))
+        else:
+            mesh = ultimaBlender.buildMesh(name, vertices, faces, UVs = UVs, materialIDs = materialIDs)
+            for frame in pieceFrames:
+                if frame not in textureFrames:
+                    with ultimaProfile.phase("materials"):
+                        textureFrames[frame] = makeMaterial(chunkTextureName(*frame))
+                mesh.materials.append(textureFrames[frame])
+
+        #add to scene
+        with ultimaProfile.phase("create objects"):
+            object = bpy.data.objects.new(name, mesh)
+            object.location = (chunkX * ChunkSize * squareLength, chunkY * ChunkSize * squareLength, 0)
+            collection.objects.link(object)
+
+    #create basic material, link texture to diffuse through image node with "extend"
+    textureArchive = ultimaFormats.openArchive(textureFilePath)
+    textureCache = getTextureCache(textureArchive) if useTextureCache else None
+    textureFiles = ultimaBlender.getTextureFiles(textureArchive) if useExternalTextures else None
+    externalImages = ultimaBlender.ExternalImages() if useExternalTextures else None
+    workers = None if useParallelDecoding else 1
+    # the frames are decoded on worker threads, a little ahead of the images being created from them here;
+    # the atlas needs the pixels of every frame, external files are only for the atlases then
+    if textureFiles is not None and useAtlas == False:
+        loadedFrames = ultimaFormats.exportTextureFrames(textureArchive, textureFrames, textureFiles, workers, *textureDetail)
+    else:
+        loadedFrames = ultimaFormats.decodeTextureFrames(textureArchive, textureFrames, textureCache, workers, *textureDetail)
+    atlasFrames = []
+    for i, ((textureIndex, frameIndex), loaded) in enumerate(ultimaProfile.timedIteration("decode textures", loadedFrames)):
+        yield "Loading textures", i, len(textureFrames)
+        if useAtlas == True:
+            frameHeader, imageData = loaded
+            ultimaProfile.addBytes("decode textures", frameHeader["width"] * frameHeader["height"] * (1 if frameHeader["is8bit"] else 2))
+            atlasFrames.append((frameHeader, imageData))
+            continue
+        if textureFiles is not None:
+            image = linkTexture(externalImages, textureIndex, frameIndex, *loaded)
+        else:
+            image = makeTexture(textureIndex, frameIndex, *loaded)
+        with ultimaProfile.phase("materials"):
+            setMaterialTexture(textureFrames[(textureIndex, frameIndex)], image)
+    if useAtlas == True and len(atlasFrames) > 0:
+        yield "Packing texture atlas", 0, 1
+        with ultimaProfile.phase("texture atlas"):
+            atlases, placements = ultimaFormats.packTextureAtlases(atlasFrames)
+        for frame, placement in zip(textureFrames, placements):
+            textureFrames[frame] = placement
+        atlasMaterials = []
+        for i, atlas in enumerate(atlases):
+            name = "{0} atlas {1}".format(objectName, i)
+            image = makeAtlasTexture(name, atlas, textureFiles, externalImages)
+            with ultimaProfile.phase("materials"):
+                atlasMaterials.append(makeMaterial(name, image))
+        print("{0} texture frames in {1} atlases".format(len(atlasFrames), len(atlases)))
+        for i, (mesh, UVs, materialIDs, pieceFrames) in enumerate(atlasPieces):
+            yield "Applying texture atlas", i, len(atlasPieces)
+            UVs, materialIDs, usedAtlases = ultimaFormats.remapAtlasUVs(UVs, materialIDs, [textureFrames[frame] for frame in pieceFrames])
+            with ultimaProfile.phase("texture atlas"):
+                applyAtlas(mesh, UVs, materialIDs, [atlasMaterials[atlas] for atlas in usedAtlases])
 
 ###
 
-class ImportUltimaTerrain(bpy.types.Operator, ImportHelper):  #map 9 is all of britannia, 14 is avatar house
+class ImportUltimaTerrain(bpy.types.Operator, ImportHelper, ultimaBlender.ImportRegionOptions, ultimaBlender.TextureDetailOptions,
+    ultimaBlender.ModalImport):  #map 9 is all of britannia, 14 is avatar house
     bl_idname       = "import_ultima_terrain.chev";
     bl_label        = "import terrain";
     bl_options      = {'PRESET'};
@@ -395,10 +245,30 @@ class ImportUltimaTerrain(bpy.types.Operator, ImportHelper):  #map 9 is all of b
         options={'HIDDEN'},
         maxlen=255,  # Max internal buffer length, longer would be clamped.
     )
+
+    useTextureCache: bpy.props.BoolProperty(name="Cache decoded textures", default = True,
+        description = "Keep decoded textures on disk so later imports don't decode them again")
+    useParallelDecoding: bpy.props.BoolProperty(name="Decode in parallel", default = True,
+        description = "Decode textures in worker threads, on all cores")
+    tileSize: bpy.props.IntProperty(name="Tile size (chunks)", default = 0, min = 0, max = 512,
+        description = "Split the terrain into one object per square of this many chunks (16 points each) a side, 0 for a single object")
+    step: bpy.props.EnumProperty(name="Detail", default = '1', items = (
+        ('1', "Full", "Every point"),
+        ('2', "1/2", "Every 2nd point"),
+        ('4', "1/4", "Every 4th point"),
+        ('8', "1/8", "Every 8th point"),
+    ), description = "Keep fewer points, for overviews. Each remaining square takes the texture of its first corner")
+    useAtlas: bpy.props.BoolProperty(name="Texture atlas", default = False,
+        description = "Pack all the terrain textures into one atlas image with a single material, instead of one material per texture")
+    useExternalTextures: bpy.props.BoolProperty(name="External texture files", default = False,
+        description = "Link textures as TGA files written once to an ultima9_textures folder next to the .blend file "
+            "(in Blender's user datafiles until it is saved), instead of packing them into the .blend file")
+
+    useCProfile: bpy.props.BoolProperty(name="Capture cProfile", default = False,
+        description = "Also record a cProfile capture of the import next to the timing report")
     
     def execute(self, context):
         print("importer start")
-        then = time.time()
 
         modelFilePath = self.filepath
         textureFilePath = os.path.join(os.path.dirname(modelFilePath), "bitmap16.flx")
@@ -406,11 +276,12 @@ class ImportUltimaTerrain(bpy.types.Operator, ImportHelper):  #map 9 is all of b
         print("importing {0}".format(modelFilePath))
         print ("textureFilePath : ", textureFilePath)
 
-        ImportModel(modelFilePath, textureFilePath) #ntpath.basename(modelFilePath[:-4]))
-
-        now = time.time()
-        print("It took: {0} seconds".format(now-then))
-        return {'FINISHED'}
+        # the import then runs from a timer, the profile summary gives its duration
+        return self.startImport(context, "terrain-" + os.path.basename(modelFilePath), ImportModel(
+            modelFilePath, textureFilePath, self.useTextureCache, self.useParallelDecoding,
+            self.importRegion(ultimaFormats.terrainPointSpacing / squareLength), self.tileSize, int(self.step), self.useAtlas,
+            self.textureDetail(), self.useExternalTextures),
+            useCProfile = self.useCProfile) #ntpath.basename(modelFilePath[:-4]))
 
 def menu_func(self, context):
     self.layout.operator(ImportUltimaTerrain.bl_idname, text="Ultima 9 terrain (terrain.*)");